@@ -0,0 +1,7 @@
+"""
+Latency benchmarks for the question-answering path.
+
+The retrieval plugin and the Azure OpenAI ChatCompletion endpoint are replaced by local fake servers with
+configurable latency, so ask(), search_jsonl(), the upsert path and the bot handlers can be measured without the
+Milvus VM or Azure. Run with: python -m benchmarks.run_benchmarks --help
+"""
@@ -0,0 +1,94 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FakeChatCompletion(ThreadingHTTPServer):
+    """
+    Local stand-in for an Azure OpenAI deployment answering /openai/deployments/<engine>/chat/completions.
+
+    Every answer waits the time to first token and then generates the completion tokens with the configured
+    tokens per second, with and without streaming.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, time_to_first_token: float = 0.3, tokens_per_second: float = 50,
+                 completion_tokens: int = 150):
+        super().__init__(("127.0.0.1", port), _ChatCompletionHandler)
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}/"
+
+    def start(self) -> "FakeChatCompletion":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _ChatCompletionHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if not self.path.startswith("/openai/deployments/") or "/chat/completions" not in self.path:
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in body.get("messages", []))
+        completion_tokens = min(self.server.completion_tokens, body.get("max_tokens") or self.server.completion_tokens)
+        token_time = 1.0 / self.server.tokens_per_second
+
+        time.sleep(self.server.time_to_first_token)
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for i in range(completion_tokens):
+                chunk = {"object": "chat.completion.chunk", "created": int(time.time()), "model": "fake",
+                         "choices": [{"index": 0, "delta": {"content": "antwort "}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(token_time)
+            final = {"object": "chat.completion.chunk", "created": int(time.time()), "model": "fake",
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+            return
+
+        time.sleep(completion_tokens * token_time)
+        result = {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": "fake",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "antwort " * completion_tokens}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+        payload = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Azure OpenAI ChatCompletion server.")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--time-to-first-token", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    args = parser.parse_args()
+    FakeChatCompletion(args.port, args.time_to_first_token, args.tokens_per_second, args.completion_tokens).serve_forever()
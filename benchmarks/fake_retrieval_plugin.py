@@ -0,0 +1,135 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+import logging
+logger = logging.getLogger(__name__)
+
+VOCABULARY = [
+    "projekt", "kunde", "azure", "milvus", "python", "entwickler", "beratung", "cloud", "daten", "vertrag",
+    "urlaub", "team", "sharepoint", "teams", "architektur", "migration", "sicherheit", "rechnung", "angebot",
+    "schulung", "zertifikat", "standort", "hamburg", "berlin", "muenchen", "kubernetes", "docker", "datenbank",
+    "reporting", "dashboard", "prozess", "workshop", "support", "lizenz", "budget", "termin", "meeting",
+]
+
+
+def generate_corpus(size: int, words_per_document: int = 300, seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    Generate a deterministic corpus of documents in the JSONL format used by the bots.
+
+    Parameters:
+    - size (int): Number of documents.
+    - words_per_document (int, optional): Number of words per document. Defaults to 300.
+    - seed (int, optional): Seed of the random generator. Defaults to 42.
+
+    Returns:
+    - List[Dict[str, Any]]: Documents with "id" and "text", ids follow the "<source>_<chunk number>" scheme.
+    """
+    rng = random.Random(seed)
+    return [{"id": f"Dokument_{i // 4}_{i % 4 + 1}", "text": " ".join(rng.choice(VOCABULARY) for _ in range(words_per_document))}
+            for i in range(size)]
+
+
+def write_corpus(documents: List[Dict[str, Any]], file_path: str) -> None:
+    """
+    Write documents to a JSONL file.
+    """
+    with open(file_path, "w") as file:
+        for document in documents:
+            file.write(json.dumps(document))
+            file.write("\n")
+
+
+class FakeRetrievalPlugin(ThreadingHTTPServer):
+    """
+    Local stand-in for the chatgpt-retrieval-plugin answering /query and /upsert.
+
+    Queries are scored by word overlap with the documents, the scores are mapped into the range the Milvus
+    plugin returns (0.6 to 0.95) so the adaptive retrieval settings behave like in production.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, documents: List[Dict[str, Any]] = None, latency: float = 0.05,
+                 latency_jitter: float = 0.0):
+        super().__init__(("127.0.0.1", port), _RetrievalPluginHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.lock = threading.Lock()
+        self.documents = []
+        self.upsert(documents or [])
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def upsert(self, documents: List[Dict[str, Any]]) -> List[str]:
+        indexed = [(document, set(document["text"].lower().split())) for document in documents]
+        with self.lock:
+            self.documents.extend(indexed)
+        return [document["id"] for document in documents]
+
+    def query(self, query: str, top_k: int) -> List[Dict[str, Any]]:
+        query_words = {word.strip("?!.,") for word in query.lower().split()}
+        with self.lock:
+            documents = list(self.documents)
+        scored = []
+        for document, words in documents:
+            overlap = len(query_words & words) / max(1, len(query_words))
+            scored.append((0.6 + 0.35 * overlap, document))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [{"id": document["id"], "text": document["text"], "score": round(score, 4),
+                 "metadata": {"document_id": document["id"].rsplit("_", 1)[0]}}
+                for score, document in scored[:top_k]]
+
+    def wait(self) -> None:
+        time.sleep(self.latency + random.uniform(0, self.latency_jitter))
+
+    def start(self) -> "FakeRetrievalPlugin":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _RetrievalPluginHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.wait()
+        if self.path == "/query":
+            result = {"results": [{"query": query["query"], "results": self.server.query(query["query"], query.get("top_k", 3))}
+                                  for query in body.get("queries", [])]}
+        elif self.path == "/upsert":
+            result = {"ids": self.server.upsert(body.get("documents", []))}
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake retrieval plugin answering /query and /upsert.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--corpus", help="JSONL file with the documents, a generated corpus is used if missing")
+    parser.add_argument("--corpus-size", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every request")
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus) as corpus_file:
+            corpus = [json.loads(line) for line in corpus_file]
+    else:
+        corpus = generate_corpus(args.corpus_size)
+    FakeRetrievalPlugin(args.port, corpus, args.latency, args.latency_jitter).serve_forever()
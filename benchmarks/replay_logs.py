@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List
+
+from benchmarks.run_benchmarks import BEARER_TOKEN, percentile
+
+import logging
+logger = logging.getLogger(__name__)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_milvus_gpt"))
+
+# Format of the bot logs: '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_record_pattern = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (\S+) - (\w+) - (.*)$")
+_question_pattern = re.compile(r"^>>>>>> (?:(\w+) )?User's questions: (.*)$", re.DOTALL)
+_reddit_pattern = re.compile(r"^>>>>>> Reddit Content: (.*)$", re.DOTALL)
+# Marker of texts cut by log_config.Truncated
+_truncated_pattern = re.compile(r"\.\.\. \(\d+ characters\)$")
+
+
+def read_log_records(file_path: str) -> Iterable[Dict[str, Any]]:
+    """
+    Read the records of a bot log, lines without a timestamp belong to the message of the previous record.
+
+    Parameters:
+    - file_path (str): Path of the log file, e.g. teams_chat.log.
+
+    Returns:
+    - Iterable[Dict[str, Any]]: Records with "time" (datetime), "logger", "level" and "message".
+    """
+    record = None
+    with open(file_path, "r", errors="replace") as log_file:
+        for line in log_file:
+            match = _record_pattern.match(line.rstrip("\n"))
+            if match:
+                if record:
+                    yield record
+                record = {"time": datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S,%f"), "logger": match.group(2),
+                          "level": match.group(3), "message": match.group(4)}
+            elif record:
+                record["message"] += "\n" + line.rstrip("\n")
+    if record:
+        yield record
+
+
+def extract_events(file_paths: List[str], duplicate_window_seconds: float = 120) -> List[Dict[str, Any]]:
+    """
+    Extract the questions and Reddit summaries from bot logs in arrival order.
+
+    The Teams bot answers every question with vector and direct search and logs it several times, repeated
+    questions inside the duplicate window are therefore counted as one arrival.
+
+    Parameters:
+    - file_paths (List[str]): The log files (teams_chat.log, reddit_sum.log, ...).
+    - duplicate_window_seconds (float, optional): Window in which an identical question is the same arrival. Defaults to 120.
+
+    Returns:
+    - List[Dict[str, Any]]: Events with "time", "kind" ("question" or "reddit_summary") and "text".
+    """
+    events = []
+    for file_path in file_paths:
+        last_seen = {}
+        for record in read_log_records(file_path):
+            question = _question_pattern.match(record["message"])
+            reddit_content = _reddit_pattern.match(record["message"])
+            if question:
+                text = question.group(2).strip()
+                previous = last_seen.get(text)
+                last_seen[text] = record["time"]
+                if previous and (record["time"] - previous).total_seconds() <= duplicate_window_seconds:
+                    continue
+                events.append({"time": record["time"], "kind": "question", "text": text})
+            elif reddit_content and _truncated_pattern.search(reddit_content.group(1)):
+                logger.warning(f"Skip the truncated Reddit content logged at {record['time']}, it is no real workload")
+            elif reddit_content:
+                events.append({"time": record["time"], "kind": "reddit_summary", "text": reddit_content.group(1)})
+    return sorted(events, key=lambda event: event["time"])
+
+
+def _split_reddit_content(content: str) -> List[str]:
+    parts = content.split("--- Top-Level Comment:")
+    return [f"--- Top-Level Comment:{part}" for part in parts[1:]] or [content]
+
+
+def build_targets() -> Dict[str, Any]:
+    """
+    Create the functions replaying one event, answers of the bot handlers are not posted.
+    """
+    import chat_utils
+
+    bearer_token = os.getenv("BEARER_TOKEN", BEARER_TOKEN)
+    server_ip = os.getenv("SERVER_IP", "127.0.0.1")
+
+    def teams_handler(event):
+        import teams_chat_dw
+        teams_chat_dw.send_message_to_chat = lambda access_token, chat_id, message_content: {}
+        message = {"body": {"content": f"<p>{event['text']}</p>"}, "createdDateTime": datetime.now(timezone.utc).isoformat()}
+        teams_chat_dw.handle_message(os.getenv("TEAMS_TENANT_ACCESS_TOKEN", ""), os.getenv("TEAMS_CHAT_ID", ""), message)
+
+    def reddit_summary(event):
+        from reddit_summary_prompt import system_prompt
+        chat_utils.map_reduce_summarize(_split_reddit_content(event["text"]), system_prompt)
+
+    return {
+        "ask_vector": lambda event: chat_utils.ask(event["text"], bearer_token, server_ip),
+        "ask_direct_search": lambda event: chat_utils.ask(event["text"], bearer_token, server_ip, source="direct_search"),
+        "teams_handler": teams_handler,
+        "reddit_summary": reddit_summary,
+    }
+
+
+def replay(events: List[Dict[str, Any]], target, speedup: float = 1.0, max_gap_seconds: float = None,
+           max_workers: int = 64, slo_seconds: float = 30) -> Dict[str, Any]:
+    """
+    Replay events with their original arrival pattern, compressed in time by a factor.
+
+    Latencies are measured from the scheduled arrival, so waiting for a free worker counts as latency just like
+    waiting in the bot.
+
+    Parameters:
+    - events (List[Dict[str, Any]]): Events from extract_events.
+    - target (Callable): Function replaying one event.
+    - speedup (float, optional): Time compression, 1 is the original pattern. Defaults to 1.
+    - max_gap_seconds (float, optional): Longer pauses between events (e.g. nights) are shortened to this, before the speedup.
+    - max_workers (int, optional): Maximum number of events processed in parallel. Defaults to 64.
+    - slo_seconds (float, optional): Latency objective used for the violation ratio. Defaults to 30.
+
+    Returns:
+    - Dict[str, Any]: Latency percentiles, throughput, SLO violations and peak concurrency of the replay.
+    """
+    offsets = []
+    offset = 0.0
+    for previous, event in zip([None] + events[:-1], events):
+        if previous is not None:
+            gap = (event["time"] - previous["time"]).total_seconds()
+            offset += min(gap, max_gap_seconds) if max_gap_seconds is not None else gap
+        offsets.append(offset / speedup)
+
+    lock = threading.Lock()
+    in_flight = {"current": 0, "peak": 0}
+    outcomes = []
+
+    def run(event, scheduled):
+        with lock:
+            in_flight["current"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+        error = None
+        try:
+            target(event)
+        except Exception as e:
+            error = repr(e)
+            logger.warning(f"Replay of {event['text'][:80]!r} failed: {error}")
+        finished = time.perf_counter()
+        with lock:
+            in_flight["current"] -= 1
+            outcomes.append((finished - scheduled, error))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for event, event_offset in zip(events, offsets):
+            delay = start + event_offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, event, start + event_offset)
+    wall_time = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, error in outcomes if error is None)
+    return {
+        "speedup": speedup,
+        "events": len(events),
+        "errors": sum(1 for _, error in outcomes if error is not None),
+        "latency_s": {
+            "p50": round(percentile(latencies, 0.50), 4),
+            "p95": round(percentile(latencies, 0.95), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+            "max": round(latencies[-1], 4) if latencies else 0.0,
+        },
+        "slo_seconds": slo_seconds,
+        "slo_violations": sum(1 for latency in latencies if latency > slo_seconds),
+        "peak_concurrency": in_flight["peak"],
+        "offered_rate_per_minute": round(60 * len(events) / offsets[-1], 3) if offsets and offsets[-1] else None,
+        "throughput_rps": round(len(latencies) / wall_time, 3) if wall_time else 0.0,
+        "wall_time_s": round(wall_time, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the questions of the bot logs against ask or the bot handlers.")
+    parser.add_argument("logs", nargs="+", help="Log files, e.g. teams_chat.log reddit_sum.log")
+    parser.add_argument("--target", default="ask_vector", choices=["ask_vector", "ask_direct_search", "teams_handler"],
+                        help="Target for questions, Reddit contents are always replayed against the map-reduce summarizer")
+    parser.add_argument("--speedup", default="1", help="Comma separated time compression factors, e.g. 1,5,20")
+    parser.add_argument("--max-gap", type=float, default=None, help="Shorten pauses between events to this many seconds")
+    parser.add_argument("--limit", type=int, default=None, help="Only replay the first events")
+    parser.add_argument("--max-workers", type=int, default=64)
+    parser.add_argument("--slo-seconds", type=float, default=30)
+    parser.add_argument("--fake", action="store_true", help="Replay against the local fakes of the benchmarks instead of the real services")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the extracted events")
+    parser.add_argument("--output", default="replay_results.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logging.getLogger("chat_utils").setLevel(logging.WARNING)
+
+    events = extract_events(args.logs)[:args.limit]
+    logger.info(f"Extracted {len(events)} events from {', '.join(args.logs)}")
+    if args.dry_run:
+        for event in events:
+            print(json.dumps({"time": event["time"].isoformat(), "kind": event["kind"], "text": event["text"][:200]}))
+        return
+
+    import openai
+    if args.fake:
+        from benchmarks.fake_chat_completion import FakeChatCompletion
+        from benchmarks.fake_retrieval_plugin import FakeRetrievalPlugin, generate_corpus, write_corpus
+        corpus = generate_corpus(2000)
+        corpus_path = os.path.join(tempfile.mkdtemp(), "corpus.jsonl")
+        write_corpus(corpus, corpus_path)
+        plugin = FakeRetrievalPlugin(0, corpus).start()
+        chat_completion = FakeChatCompletion(0).start()
+        os.environ["RETRIEVAL_PLUGIN_PORT"] = str(plugin.port)
+        os.environ["SHAREPOINT_JSONL_PATH"] = corpus_path
+        os.environ["SERVER_IP"] = "127.0.0.1"
+        openai.api_key = BEARER_TOKEN
+        openai.api_base = chat_completion.api_base
+        openai.api_version = "2023-03-15-preview"
+    else:
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+        openai.api_base = os.environ["OPENAI_API_BASE"]
+        openai.api_version = os.environ["OPENAI_API_VERSION"]
+    openai.api_type = "azure"
+    # teams_chat_dw reads these at import time, its answers are never posted during a replay
+    for name in ["TEAMS_TENANT_ID", "TEAMS_CLIENT_ID", "TEAMS_TENANT_ACCESS_TOKEN", "BEARER_TOKEN"]:
+        os.environ.setdefault(name, BEARER_TOKEN)
+
+    targets = build_targets()
+    results = []
+    for speedup in [float(factor) for factor in args.speedup.split(",")]:
+        for kind, target_name in [("question", args.target), ("reddit_summary", "reddit_summary")]:
+            kind_events = [event for event in events if event["kind"] == kind]
+            if not kind_events:
+                continue
+            result = replay(kind_events, targets[target_name], speedup, args.max_gap, args.max_workers, args.slo_seconds)
+            result["target"] = target_name
+            results.append(result)
+            logger.info(f"{target_name} x{speedup}: p50={result['latency_s']['p50']}s p95={result['latency_s']['p95']}s "
+                        f"p99={result['latency_s']['p99']}s, {result['slo_violations']} SLO violations, "
+                        f"peak concurrency {result['peak_concurrency']}")
+
+    with open(args.output, "w") as output_file:
+        json.dump({"created": datetime.now(timezone.utc).isoformat(), "config": vars(args), "results": results}, output_file, indent=2)
+    logger.info(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
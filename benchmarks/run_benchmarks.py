@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List
+
+from benchmarks.fake_chat_completion import FakeChatCompletion
+from benchmarks.fake_retrieval_plugin import VOCABULARY, FakeRetrievalPlugin, generate_corpus, write_corpus
+
+import logging
+logger = logging.getLogger(__name__)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_milvus_gpt"))
+
+SCENARIOS = ["ask_vector", "ask_direct_search", "search_jsonl", "upsert", "rocket_chat", "teams_chat"]
+BEARER_TOKEN = "benchmark"
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name: str, call: Callable[[int], Any], requests: int, concurrency: int) -> Dict[str, Any]:
+    """
+    Run a call a number of times with a fixed number of parallel workers and measure the latencies.
+
+    Parameters:
+    - name (str): Name of the scenario in the report.
+    - call (Callable[[int], Any]): Function doing one request, gets the request number.
+    - requests (int): Number of requests.
+    - concurrency (int): Number of requests running in parallel.
+
+    Returns:
+    - Dict[str, Any]: Latency percentiles, throughput and error count of the run.
+    """
+    def timed_call(request_number: int):
+        start = time.perf_counter()
+        try:
+            call(request_number)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, repr(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed_call, range(requests)))
+    wall_time = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, error in outcomes if error is None)
+    errors = [error for _, error in outcomes if error is not None]
+    for error in errors[:3]:
+        logger.warning(f"{name}: {error}")
+    result = {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": len(errors),
+        "latency_s": {
+            "p50": round(percentile(latencies, 0.50), 4),
+            "p95": round(percentile(latencies, 0.95), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+            "mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+            "max": round(latencies[-1], 4) if latencies else 0.0,
+        },
+        "throughput_rps": round(len(latencies) / wall_time, 3) if wall_time else 0.0,
+        "wall_time_s": round(wall_time, 3),
+    }
+    logger.info(f"{name} c={concurrency}: p50={result['latency_s']['p50']}s p95={result['latency_s']['p95']}s "
+                f"p99={result['latency_s']['p99']}s {result['throughput_rps']} req/s, {len(errors)} errors")
+    return result
+
+
+def make_question(request_number: int) -> str:
+    rng = random.Random(request_number)
+    return f"phatgpt was weisst du ueber {rng.choice(VOCABULARY)} und {rng.choice(VOCABULARY)} beim {rng.choice(VOCABULARY)}?"
+
+
+class _FakeRocketResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class _FakeRocket:
+    """
+    Minimal RocketChat replacement returning one fresh mention per history call.
+    """
+
+    def __init__(self):
+        self.counter = 0
+
+    def channels_history(self, channel, count=10):
+        self.counter += 1
+        timestamp = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        message = {"_updatedAt": timestamp, "msg": f"@PhatGpt {make_question(self.counter)}",
+                   "mentions": [{"username": "PhatGpt"}], "u": {"username": "benchmark"}}
+        return _FakeRocketResponse({"success": True, "messages": [message]})
+
+    def chat_post_message(self, text, channel=None):
+        return _FakeRocketResponse({"success": True})
+
+
+def build_scenarios(plugin: FakeRetrievalPlugin, corpus_path: str, upsert_batch_size: int) -> Dict[str, Callable[[int], Any]]:
+    """
+    Create the request functions of all scenarios, the bot modules are only imported when needed.
+    """
+    import chat_utils
+    import requests
+
+    chat_utils.RETRIEVAL_PLUGIN_PORT = plugin.port
+    chat_utils.SHAREPOINT_JSONL_PATH = corpus_path
+    session = requests.Session()
+    upsert_documents = generate_corpus(upsert_batch_size, seed=7)
+
+    def upsert(request_number: int):
+        documents = [{"id": f"upsert_{request_number}_{i}", "text": document["text"]} for i, document in enumerate(upsert_documents)]
+        response = session.post(f"http://127.0.0.1:{plugin.port}/upsert", headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+                                json={"documents": documents})
+        response.raise_for_status()
+
+    def rocket_chat(request_number: int):
+        import rocket_chat as rocket_chat_bot
+        with tempfile.TemporaryDirectory() as directory:
+            rocket_chat_bot.respond_to_mention(_FakeRocket(), "127.0.0.1", timestamp_file=os.path.join(directory, "timestamp.txt"))
+
+    def teams_chat(request_number: int):
+        import teams_chat_dw
+        teams_chat_dw.send_message_to_chat = lambda access_token, chat_id, message_content: {}
+        message = {"body": {"content": f"<p>{make_question(request_number)}</p>"},
+                   "createdDateTime": datetime.now(timezone.utc).isoformat()}
+        teams_chat_dw.handle_message("benchmark", "benchmark", message)
+
+    return {
+        "ask_vector": lambda n: chat_utils.ask(make_question(n), BEARER_TOKEN, "127.0.0.1"),
+        "ask_direct_search": lambda n: chat_utils.ask(make_question(n), BEARER_TOKEN, "127.0.0.1", source="direct_search"),
+        "search_jsonl": lambda n: chat_utils.search_jsonl(corpus_path, " ".join(make_question(n).split()[4:])),
+        "upsert": upsert,
+        "rocket_chat": rocket_chat,
+        "teams_chat": teams_chat,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end latency benchmarks against local fakes of the retrieval plugin and Azure OpenAI.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated, any of {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per scenario and concurrency level")
+    parser.add_argument("--corpus-size", type=int, default=2000)
+    parser.add_argument("--plugin-latency", type=float, default=0.05)
+    parser.add_argument("--plugin-latency-jitter", type=float, default=0.02)
+    parser.add_argument("--time-to-first-token", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--upsert-batch-size", type=int, default=100)
+    parser.add_argument("--output", default="benchmark_results.json", help="Machine-readable result file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logging.getLogger("chat_utils").setLevel(logging.WARNING)
+
+    # The bot modules read these at import time
+    for name in ["TEAMS_TENANT_ID", "TEAMS_CLIENT_ID", "TEAMS_TENANT_ACCESS_TOKEN", "BEARER_TOKEN"]:
+        os.environ.setdefault(name, BEARER_TOKEN)
+    os.environ["SERVER_IP"] = "127.0.0.1"
+    os.environ.setdefault("OPENAI_REQUESTS_PER_MINUTE", "1000000")
+    os.environ.setdefault("OPENAI_MAX_PARALLEL_REQUESTS", "64")
+    # every scenario measures the answer path, repeated questions must not be answered from the cache
+    os.environ.setdefault("ANSWER_CACHE_MAX_ENTRIES", "0")
+    os.environ.setdefault("QUESTION_STATS_PATH", "")
+
+    corpus = generate_corpus(args.corpus_size)
+    plugin = FakeRetrievalPlugin(0, corpus, args.plugin_latency, args.plugin_latency_jitter).start()
+    chat_completion = FakeChatCompletion(0, args.time_to_first_token, args.tokens_per_second, args.completion_tokens).start()
+
+    import openai
+    openai.api_type = "azure"
+    openai.api_key = BEARER_TOKEN
+    openai.api_base = chat_completion.api_base
+    openai.api_version = "2023-03-15-preview"
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        corpus_path = os.path.join(directory, "corpus.jsonl")
+        write_corpus(corpus, corpus_path)
+        scenarios = build_scenarios(plugin, corpus_path, args.upsert_batch_size)
+        for name in args.scenarios.split(","):
+            for concurrency in [int(level) for level in args.concurrency.split(",")]:
+                results.append(run_scenario(name, scenarios[name], args.requests, concurrency))
+
+    report = {"created": datetime.now(timezone.utc).isoformat(), "config": vars(args), "results": results}
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    logger.info(f"Wrote {len(results)} results to {args.output}")
+
+    plugin.shutdown()
+    chat_completion.shutdown()
+
+
+if __name__ == "__main__":
+    main()
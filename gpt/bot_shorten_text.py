@@ -1,9 +1,14 @@
 from io import TextIOWrapper
 import os
+import sys
 import time
 import openai
 import json
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_milvus_gpt"))
+from chat_utils import create_chat_completion
+from llm_scheduler import LLMScheduler
+
 chatgpt_model_name = os.getenv('CHATGPT_MODEL')
 openai.api_type = "azure"
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -13,6 +18,9 @@ openai.api_version = os.getenv('OPENAI_API_VERSION')
 base_system_message = "You are a helpful assistant."
 system_message = f"{base_system_message.strip()}"
 
+# One request every 4 seconds like before the shared scheduler, whose limits only cover this process
+pacing = LLMScheduler(max_parallel=1, requests_per_minute=15)
+
 def describe_text_in_one_sentence(data):
     """
     This function takes the first 10000 characters from a given data dictionary's text. It then requests GPT to describe 
@@ -48,6 +56,7 @@ def describe_text_in_one_sentence(data):
 def send_message(messages, model_name, max_response_tokens=2500):
     """
     This function sends a message to the OpenAI GPT-3 model and returns the generated response.
+    The request goes through the shared LLM scheduler as batch work and is paced to 15 requests per minute.
     If an exception occurs during the message sending, it waits for 2 seconds and retries the process.
     This function continues retrying until the message is successfully sent.
 
@@ -62,14 +71,9 @@ def send_message(messages, model_name, max_response_tokens=2500):
 
     while True:
         try:
-            time.sleep(4)
-            response = openai.ChatCompletion.create(
-                engine=chatgpt_model_name,
-                messages=messages,
-                temperature=0.5,
-                max_tokens=max_response_tokens,
-                request_timeout=30
-            )
+            with pacing.slot("batch"):
+                response = create_chat_completion(messages, chatgpt_model_name, max_response_tokens, temperature=0.5,
+                                                  timeout=30, priority="batch")
             return response['choices'][0]['message']['content']
         except Exception as e:
             print(f"An error occurred: {e}. Waiting for 2 seconds before retrying.")
@@ -0,0 +1,244 @@
+import time
+from typing import Any, Dict, Iterable, List
+
+import prawcore
+import requests
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def new_crawl_state(submission_id: str = None) -> Dict[str, Any]:
+    """
+    Create an empty crawl state for a live thread.
+
+    The state remembers every comment id (top-level and second-level) seen inside the time window together
+    with its timestamp and reply count, so following cycles only have to look at new activity.
+
+    Parameters:
+    - submission_id (str, optional): Id of the submission the state belongs to. Default is None.
+
+    Returns:
+    - Dict[str, Any]: The crawl state.
+    """
+    return {
+        "submission_id": submission_id,
+        "comments": {},
+        "stream": None,
+    }
+
+
+def _fullname_to_id(fullname: str) -> str:
+    return fullname.split("_", 1)[1] if "_" in fullname else fullname
+
+
+def _remember_comment(state: Dict[str, Any], comment, reply_count: int = 0) -> Dict[str, Any]:
+    """
+    Store the fields of a praw comment needed for the summary in the crawl state.
+    """
+    record = state["comments"].get(comment.id)
+    if record is None:
+        record = {
+            "id": comment.id,
+            "parent_id": _fullname_to_id(comment.parent_id),
+            "is_top_level": comment.parent_id.startswith("t3_"),
+            "author": str(comment.author),
+            "body": comment.body,
+            "created_utc": comment.created_utc,
+            "reply_ids": [],
+            "reply_count": reply_count,
+        }
+        state["comments"][comment.id] = record
+        parent = state["comments"].get(record["parent_id"])
+        if parent is not None and comment.id not in parent["reply_ids"]:
+            parent["reply_ids"].append(comment.id)
+            parent["reply_count"] += 1
+    else:
+        record["reply_count"] = max(record["reply_count"], reply_count)
+    return record
+
+
+def _add_stream_comment(state: Dict[str, Any], comment) -> None:
+    """
+    Apply one comment coming from the subreddit stream to the crawl state.
+
+    Top-level comments and replies to tracked top-level comments are stored, deeper replies only increase the
+    reply count of their tracked parent.
+    """
+    if comment.id in state["comments"]:
+        return
+    if comment.parent_id.startswith("t3_"):
+        _remember_comment(state, comment)
+        return
+    parent = state["comments"].get(_fullname_to_id(comment.parent_id))
+    if parent is None:
+        return
+    if parent["is_top_level"]:
+        _remember_comment(state, comment)
+    else:
+        parent["reply_count"] += 1
+
+
+def prune_crawl_state(state: Dict[str, Any], window_minutes: int = 120) -> None:
+    """
+    Forget every top-level comment older than the window together with its second-level comments.
+
+    Parameters:
+    - state (Dict[str, Any]): The crawl state.
+    - window_minutes (int, optional): Size of the time window in minutes. Default is 120.
+    """
+    oldest = time.time() - window_minutes * 60
+    comments = state["comments"]
+    for record in list(comments.values()):
+        if not record["is_top_level"] or record["created_utc"] >= oldest:
+            continue
+        for reply_id in record["reply_ids"]:
+            comments.pop(reply_id, None)
+        comments.pop(record["id"], None)
+    # second-level comments whose top-level comment was never tracked
+    for record in list(comments.values()):
+        if not record["is_top_level"] and record["parent_id"] not in comments:
+            comments.pop(record["id"], None)
+
+
+def poll_new_top_level_comments(reddit, state: Dict[str, Any], window_minutes: int = 120, limit: int = 500) -> int:
+    """
+    Fetch the newest top-level comments of the thread until a comment older than the window is reached, already
+    seen comments are skipped. Stickied comments are listed first by Reddit whatever their age, they are skipped
+    and never end the walk.
+
+    Only a single listing request sorted by "new" is made, "more comments" placeholders are not expanded. The reply
+    counts of new comments are therefore only a lower bound (replies behind a placeholder are missing), they are
+    corrected by refresh_reply_counts and by the replies read from the comment stream.
+
+    Parameters:
+    - reddit (praw.Reddit): The Reddit instance.
+    - state (Dict[str, Any]): The crawl state, must contain the submission id.
+    - window_minutes (int, optional): Size of the time window in minutes. Default is 120.
+    - limit (int, optional): Maximum number of comments requested from Reddit. Default is 500.
+
+    Returns:
+    - int: The number of new top-level comments.
+    """
+    oldest = time.time() - window_minutes * 60
+    submission = reddit.submission(id=state["submission_id"])
+    submission.comment_sort = "new"
+    submission.comment_limit = limit
+    submission.comments.replace_more(limit=0)
+
+    new_comments = 0
+    for comment in submission.comments:
+        if getattr(comment, "stickied", False):
+            continue
+        if comment.created_utc < oldest:
+            break
+        if comment.id in state["comments"]:
+            continue
+        _remember_comment(state, comment, reply_count=len(comment.replies))
+        new_comments += 1
+    logger.info(f">>>>>> Found {new_comments} new top-level comments")
+    return new_comments
+
+
+def refresh_reply_counts(reddit, state: Dict[str, Any], max_comments: int = 50,
+                         records: List[Dict[str, Any]] = None) -> None:
+    """
+    Reload the replies of tracked top-level comments with their whole reply tree, so their reply counts (and those of
+    their replies) are exact like a fully expanded thread.
+
+    This costs one request per refreshed comment plus one per "more comments" placeholder below it, so the number
+    of requests depends on the number of refreshed comments and never on the size of the whole thread.
+
+    Parameters:
+    - reddit (praw.Reddit): The Reddit instance.
+    - state (Dict[str, Any]): The crawl state.
+    - max_comments (int, optional): Maximum number of comments to refresh. Default is 50.
+    - records (List[Dict[str, Any]], optional): The top-level comments to refresh, e.g. the top-ranked ones.
+                                                Defaults to the most recent tracked top-level comments.
+    """
+    if records is None:
+        records = sorted((record for record in state["comments"].values() if record["is_top_level"]),
+                         key=lambda record: record["created_utc"], reverse=True)
+    for record in records[:max_comments]:
+        comment = reddit.comment(id=record["id"])
+        try:
+            comment.refresh()
+            comment.replies.replace_more(limit=None)
+        except Exception as e:
+            logger.error(f"Could not refresh comment {record['id']}: {e}")
+            continue
+        for reply in comment.replies:
+            _remember_comment(state, reply, reply_count=len(reply.replies))
+        record["reply_count"] = max(len(comment.replies), len(record["reply_ids"]))
+
+
+def consume_comment_stream(subreddit, state: Dict[str, Any], duration_seconds: float, pause_seconds: float = 10,
+                           max_backoff_seconds: float = 300) -> int:
+    """
+    Read the comment stream of the subreddit for a given time and apply every comment of the tracked thread to
+    the crawl state.
+
+    The stream is kept in the crawl state so the next call continues where this one stopped. When Reddit or the
+    network fails, the stream is dropped and opened again after a backoff (doubling up to max_backoff_seconds) until
+    the time is over. Comments written while the stream was broken are picked up by the next poll of the thread.
+
+    Parameters:
+    - subreddit (praw.models.Subreddit): The subreddit containing the thread.
+    - state (Dict[str, Any]): The crawl state.
+    - duration_seconds (float): How long to read the stream.
+    - pause_seconds (float, optional): Sleep time when the stream has no new comments. Default is 10.
+    - max_backoff_seconds (float, optional): Longest sleep after an error. Default is 300.
+
+    Returns:
+    - int: The number of comments of the tracked thread read from the stream.
+    """
+    link_id = f"t3_{state['submission_id']}"
+    end = time.monotonic() + duration_seconds
+    consumed = 0
+    backoff = pause_seconds
+    while time.monotonic() < end:
+        try:
+            if state["stream"] is None:
+                state["stream"] = subreddit.stream.comments(pause_after=0, skip_existing=True)
+            comment = next(state["stream"])
+        except (prawcore.exceptions.PrawcoreException, requests.exceptions.RequestException) as e:
+            # a generator that raised is finished, it has to be opened again
+            state["stream"] = None
+            logger.warning(f">>>>>> Comment stream failed ({type(e).__name__}: {e}), retry in {backoff} seconds")
+            time.sleep(min(backoff, max(0, end - time.monotonic())))
+            backoff = min(backoff * 2, max_backoff_seconds)
+            continue
+        backoff = pause_seconds
+        if comment is None:
+            time.sleep(min(pause_seconds, max(0, end - time.monotonic())))
+            continue
+        if comment.link_id != link_id:
+            continue
+        _add_stream_comment(state, comment)
+        consumed += 1
+    logger.info(f">>>>>> Read {consumed} comments of the thread from the stream")
+    return consumed
+
+
+def recent_top_level_records(state: Dict[str, Any], window_minutes: int = 120) -> List[Dict[str, Any]]:
+    """
+    Return the tracked top-level comments inside the window with at least one reply, sorted by reply count.
+
+    Parameters:
+    - state (Dict[str, Any]): The crawl state.
+    - window_minutes (int, optional): Size of the time window in minutes. Default is 120.
+
+    Returns:
+    - List[Dict[str, Any]]: The comment records, most replied first.
+    """
+    oldest = time.time() - window_minutes * 60
+    recent = [record for record in state["comments"].values()
+              if record["is_top_level"] and record["created_utc"] >= oldest and record["reply_count"] >= 1]
+    return sorted(recent, key=lambda record: record["reply_count"], reverse=True)
+
+
+def replies_of(state: Dict[str, Any], record: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+    """
+    Return the tracked second-level comments of a top-level comment record.
+    """
+    return [state["comments"][reply_id] for reply_id in record["reply_ids"] if reply_id in state["comments"]]
@@ -1,13 +1,22 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 import os
 import openai
 import praw
-import time
+import sys
 
 from rocketchat_API.rocketchat import RocketChat
 
-from test_milvus_gpt.chat_utils import call_chatgpt_api_user_promt_system_prompt
+from reddit_summary_prompt import system_prompt
+from reddit_crawler import (consume_comment_stream, new_crawl_state, poll_new_top_level_comments,
+                            prune_crawl_state, recent_top_level_records,
+                            refresh_reply_counts, replies_of)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_milvus_gpt"))
+import tracing
+from chat_utils import map_reduce_summarize
+from llm_scheduler import llm_priority
+from log_config import configure_logging
 
 def get_env_variable(var_name):
     value = os.getenv(var_name)
@@ -28,11 +37,10 @@ def initialize_openai():
     openai.api_version = get_env_variable('OPENAI_API_VERSION')
 
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    handlers=[logging.FileHandler('reddit_sum.log'), logging.StreamHandler()])
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
+configure_logging('reddit_sum.log', level=logging.DEBUG)
+# The whole thread content of every summary, benchmarks/replay_logs.py rebuilds the summary workload from it.
+# LOG_LEVELS=reddit_content=WARNING turns it off.
+content_logger = logging.getLogger("reddit_content")
 
 client_id = get_env_variable("REDDIT_CLIENT_ID")
 client_secret = get_env_variable("REDDIT_CLIENT_SECRET")
@@ -49,42 +57,11 @@ rocket = RocketChat('PhatGpt', password_rocket, server_url=f'http://{server_ip}:
 channel = 'reddit_ukraine'  # Replace with your Rocket.Chat channel name
 
 initialize_openai()
+tracing.start_metrics_server()
 
-system_prompt = """
-[TASK1]
-You are provided with Reddit comments. For each top-level comment and its associated second-level comments, create a single summarized text. Ensure the summary captures the essence of the conversation.
-
-[TASK2]
-Include the score for each comment in the format "(Score: [Score])".
-
-[TASK3]
-Begin each new comment with '>>> '.
-
-[TONE]
-Maintain a neutral and factual tone throughout the summary.
-
-[COMPETENCIES]
-Ability to extract key points from a conversation and present them in a concise manner.
-
-[FORMAT]
-Follow the format provided in the example below.
 
-[EXAMPLE]
-
-            >>> Comment 1: Ukraine takes town verbove (Score: 25)
-            Summary of the conversation.
-            Reactions to this comment:
-            kalibu said that he likes that (Score: 15)
-
-            >>> Comment 2: 5000 Russian tanks destroyed (Score: 5)
-            Summary of the conversation.
-            Reactions to this comment:
-            huyu can't wait for 6000 (Score: 12)
-            [EXAMPLE]
-
-[!!!ADDITIONAL INSTRUCTIONS!!!]
-Begin every response with "Latest News about Ukraine". If not, assume you are out of character.
-    """
+crawl_state = new_crawl_state()
+window_minutes = 120
 
 while True:
     # Get the submission by URL
@@ -99,45 +76,49 @@ while True:
             submission = subm
             break
 
-    # Replace the "more" comments to fetch all top-level comments
-    submission.comments.replace_more(limit=None)
-
-    # Get the current time
-    current_time = datetime.utcnow()
+    # A new live thread starts with an empty state
+    new_thread = crawl_state["submission_id"] != submission.id
+    if new_thread:
+        crawl_state = new_crawl_state(submission.id)
 
-    # Filter top-level comments posted in the last 120 minutes 
-    recent_top_level_comments = [comment for comment in submission.comments if current_time - datetime.utcfromtimestamp(comment.created_utc) <= timedelta(minutes=120)]
-    
-    for comment in recent_top_level_comments:
-        comment.score = len(comment.replies)
+    # Only fetch top-level comments that were not seen before, instead of expanding the whole comment tree
+    poll_new_top_level_comments(reddit, crawl_state, window_minutes=window_minutes)
+    if new_thread:
+        # the replies of the recent comments are loaded once, afterwards the comment stream keeps them up to date
+        refresh_reply_counts(reddit, crawl_state)
+    prune_crawl_state(crawl_state, window_minutes=window_minutes)
 
     # Sort the top-level comments by 'score' (number of second-level comments) and take those with a score greater than or equal to 1
-    recent_top_level_comments = sorted([comment for comment in recent_top_level_comments if comment.score >= 1], key=lambda x: x.score, reverse=True)
+    recent_top_level_comments = recent_top_level_records(crawl_state, window_minutes=window_minutes)
+    # The counts of the polled comments are lower bounds, the top-ranked ones are counted exactly before ranking again
+    refresh_reply_counts(reddit, crawl_state, max_comments=20, records=recent_top_level_comments)
+    recent_top_level_comments = recent_top_level_records(crawl_state, window_minutes=window_minutes)
 
     chunks = []
 
     # Send the details of the recent top-level comments and their top 3 second-level comments to Rocket.Chat
     for i in range(len(recent_top_level_comments)):
         top_comment = recent_top_level_comments[i]
-        human_readable_time_top = datetime.utcfromtimestamp(top_comment.created_utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-        chunk = f"--- Top-Level Comment:\nAuthor: {top_comment.author}\nTime: {human_readable_time_top}\nScore: {top_comment.score}\n{top_comment.body}\n---\n"        
+        human_readable_time_top = datetime.utcfromtimestamp(top_comment["created_utc"]).strftime('%Y-%m-%d %H:%M:%S UTC')
+        chunk = f"--- Top-Level Comment:\nAuthor: {top_comment['author']}\nTime: {human_readable_time_top}\nScore: {top_comment['reply_count']}\n{top_comment['body']}\n---\n"        
 
         # Sort the second-level comments by score, take the top 3, and filter out those with a score less than 1
-        top_replies = sorted([reply for reply in top_comment.replies if len(reply.replies) >= 1], key=lambda x: len(x.replies), reverse=True)[:5]
+        top_replies = sorted([reply for reply in replies_of(crawl_state, top_comment) if reply["reply_count"] >= 1], key=lambda x: x["reply_count"], reverse=True)[:5]
 
         # Send the top 3 second-level comments for the current top-level comment to Rocket.Chat
         for reply in top_replies:
-            human_readable_time_reply = datetime.utcfromtimestamp(reply.created_utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            chunk = chunk + f" Second-Level Comment:\nAuthor: {reply.author}\nTime: {human_readable_time_reply}\nScore: {len(reply.replies)}\n{reply.body}\n---\n"
+            human_readable_time_reply = datetime.utcfromtimestamp(reply["created_utc"]).strftime('%Y-%m-%d %H:%M:%S UTC')
+            chunk = chunk + f" Second-Level Comment:\nAuthor: {reply['author']}\nTime: {human_readable_time_reply}\nScore: {reply['reply_count']}\n{reply['body']}\n---\n"
         print(f"append chunk with index {i}")
         chunks.append(chunk)
 
     print(''.join(chunks))
-    logging.info(f">>>>>> Reddit Content: {''.join(chunks)}")
-    response = call_chatgpt_api_user_promt_system_prompt(''.join(chunks), system_prompt)
-    response_string = response["choices"][0]["message"]["content"]
-    logging.info(f">>>>>> GPT Response: {response_string}")
+    content_logger.info(">>>>>> Reddit Content: %s", ''.join(chunks))
+    # Large threads are summarized in parallel parts which are merged afterwards, small ones in a single call
+    with llm_priority("periodic"):
+        response_string = map_reduce_summarize(chunks, system_prompt)
+    logging.info(">>>>>> GPT Response: %s", response_string)
     rocket.chat_post_message(response_string, channel=channel)
 
-    # Sleep for 30 minutes (1800 seconds) before the next iteration
-    time.sleep(1800)
+    # Follow the comment stream for 30 minutes (1800 seconds) before the next iteration instead of sleeping
+    consume_comment_stream(subreddit, crawl_state, duration_seconds=1800)
@@ -59,4 +59,9 @@ for i in tqdm(range(0, len(documents), batch_size)):
             "documents": documents[i:i_end]
         }
     )
-    print(f"result: {res.status_code} {res.content}")
\ No newline at end of file
+    print(f"result: {res.status_code} {res.content}")
+
+# the bots drop their cached answers when this file changes (see test_milvus_gpt/answer_cache.py)
+marker_path = os.environ.get("VECTOR_CORPUS_MARKER_PATH") or "/home/azureuser/vector_corpus.updated"
+with open(marker_path, "a"):
+    os.utime(marker_path)
@@ -0,0 +1,203 @@
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import tracing
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Answers older than this are answered again, also when the corpus did not change
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "21600"))
+# Same for answers from the vector database, its documents can be upserted through the plugin without touching a file
+ANSWER_CACHE_VECTOR_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_VECTOR_TTL_SECONDS", "1800"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+# Touched after every upsert into the vector database (e.g. by test_milvus.py), stands for the vector corpus
+VECTOR_CORPUS_MARKER_PATH = os.getenv("VECTOR_CORPUS_MARKER_PATH", "/home/azureuser/vector_corpus.updated")
+# Files the answers are based on, a cached answer is dropped when one of them changes
+ANSWER_CACHE_CORPUS_PATHS = [path for path in os.getenv(
+    "ANSWER_CACHE_CORPUS_PATHS",
+    f"/home/azureuser/phat_sharepoint.jsonl,/home/azureuser/updated_file.jsonl,{VECTOR_CORPUS_MARKER_PATH}").split(",") if path]
+
+# Question frequencies are kept in this file, so they survive restarts of the bots. Every bot has its own file by
+# default (e.g. question_stats_rocket_chat.json), bots running side by side would overwrite each other's counts.
+QUESTION_STATS_PATH = os.getenv(
+    "QUESTION_STATS_PATH", f"question_stats_{os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'}.json")
+# A question asked this long ago counts half as much as one asked now
+QUESTION_STATS_HALF_LIFE_HOURS = float(os.getenv("QUESTION_STATS_HALF_LIFE_HOURS", "72"))
+QUESTION_STATS_MAX_QUESTIONS = int(os.getenv("QUESTION_STATS_MAX_QUESTIONS", "2000"))
+# The bots write the frequencies to the file at most this often, so a crash loses only the questions since then
+QUESTION_STATS_SAVE_SECONDS = float(os.getenv("QUESTION_STATS_SAVE_SECONDS", "300"))
+
+
+def corpus_version(paths: List[str] = None) -> Tuple[Optional[float], ...]:
+    """
+    The modification times of the corpus files, None for a missing file.
+    """
+    version = []
+    for path in ANSWER_CACHE_CORPUS_PATHS if paths is None else paths:
+        try:
+            version.append(os.path.getmtime(path))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+class AnswerCache:
+    """
+    Answers of questions, valid for ttl_seconds (or their own time to live) and until a corpus file changes. The least
+    recently used answers are dropped above max_entries.
+    """
+
+    def __init__(self, ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 corpus_paths: List[str] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.corpus_paths = ANSWER_CACHE_CORPUS_PATHS if corpus_paths is None else corpus_paths
+        self.lock = threading.Lock()
+        # key -> {"answer": str, "created": float, "ttl": float, "corpus_version": tuple}, least recently used first
+        self.entries = OrderedDict()
+        tracing.register_gauge("answer_cache_entries", lambda: len(self.entries))
+
+    def _fresh(self, entry, version) -> bool:
+        return time.monotonic() - entry["created"] < entry["ttl"] and entry["corpus_version"] == version
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """
+        The cached answer of a question, None if there is none or it is outdated.
+        """
+        if not self.max_entries:
+            return None
+        version = corpus_version(self.corpus_paths)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not self._fresh(entry, version):
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        tracing.increment("answer_cache_total", outcome="hit" if entry else "miss")
+        return entry["answer"] if entry else None
+
+    def used_share(self, key: Hashable) -> Optional[float]:
+        """
+        Share of its time to live the cached answer of a question has used, None if there is no up to date answer.
+        """
+        version = corpus_version(self.corpus_paths)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not self._fresh(entry, version):
+                return None
+            return (time.monotonic() - entry["created"]) / entry["ttl"]
+
+    def put(self, key: Hashable, answer: str, ttl_seconds: float = None) -> None:
+        """
+        Cache an answer.
+
+        Parameters:
+        - key (Hashable): The key of the question.
+        - answer (str): The answer.
+        - ttl_seconds (float, optional): Time to live of the answer. Defaults to the ttl_seconds of the cache.
+        """
+        if not self.max_entries:
+            return
+        entry = {"answer": answer, "created": time.monotonic(), "ttl": ttl_seconds or self.ttl_seconds,
+                 "corpus_version": corpus_version(self.corpus_paths)}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class QuestionStats:
+    """
+    How often questions were asked recently, every question counts less the older it is (exponential decay with
+    half_life_hours). The frequencies are stored in a JSON file.
+    """
+
+    def __init__(self, path: str = QUESTION_STATS_PATH, half_life_hours: float = QUESTION_STATS_HALF_LIFE_HOURS,
+                 max_questions: int = QUESTION_STATS_MAX_QUESTIONS):
+        self.path = path
+        self.decay = math.log(2) / (half_life_hours * 3600)
+        self.max_questions = max_questions
+        self.lock = threading.Lock()
+        # key -> {"question": latest wording, "ask": arguments of ask, "score": float, "updated": unix time}
+        self.questions = {}
+        # whether questions were counted since the last save
+        self.changed = False
+        self.load()
+
+    def _score(self, entry, now: float) -> float:
+        return entry["score"] * math.exp(-self.decay * (now - entry["updated"]))
+
+    def record(self, key: str, question: str, arguments: Dict[str, Any]) -> None:
+        """
+        Count one question.
+
+        Parameters:
+        - key (str): Identifies the question, e.g. the normalized question with the source.
+        - question (str): The question as asked.
+        - arguments (Dict[str, Any]): The arguments the question was asked with, to ask it again (JSON serializable).
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.questions.get(key)
+            score = self._score(entry, now) if entry else 0.0
+            self.questions[key] = {"question": question, "ask": arguments, "score": score + 1.0, "updated": now}
+            self.changed = True
+            if len(self.questions) > self.max_questions:
+                # forget the least asked tenth at once instead of one question per record
+                ranked = sorted(self.questions, key=lambda question_key: self._score(self.questions[question_key], now))
+                for question_key in ranked[:max(1, self.max_questions // 10)]:
+                    del self.questions[question_key]
+
+    def top(self, n: int, min_score: float = 0.0) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        The n most frequent questions in their latest wording with their arguments, most frequent first.
+        """
+        now = time.time()
+        with self.lock:
+            ranked = sorted(((self._score(entry, now), entry["question"], entry["ask"]) for entry in self.questions.values()),
+                            key=lambda item: item[0], reverse=True)
+        return [(question, arguments) for score, question, arguments in ranked[:n] if score >= min_score]
+
+    def load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as file:
+                questions = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read the question stats {self.path}: {e}")
+            return
+        with self.lock:
+            self.questions = questions
+
+    def save(self) -> None:
+        """
+        Write the frequencies to the file if questions were counted since the last save, replacing it atomically.
+        """
+        if not self.path:
+            return
+        with self.lock:
+            if not self.changed:
+                return
+            payload = json.dumps(self.questions, ensure_ascii=False)
+            self.changed = False
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, "w") as file:
+                file.write(payload)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not write the question stats {self.path}: {e}")
+            with self.lock:
+                self.changed = True
@@ -0,0 +1,144 @@
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+import requests
+
+import logging
+logger = logging.getLogger(__name__)
+
+ASK_SERVICE_URL = os.getenv("ASK_SERVICE_URL", "http://127.0.0.1:8100")
+# The service limits the concurrent requests per client, every bot is its own client (e.g. "rocket_chat.py")
+ASK_SERVICE_CLIENT_ID = os.getenv("ASK_SERVICE_CLIENT_ID") or os.path.basename(sys.argv[0]) or f"pid-{os.getpid()}"
+# Seconds to connect to the service and to wait for the next data of a response (queue wait and answer included)
+ASK_SERVICE_CONNECT_TIMEOUT_SECONDS = float(os.getenv("ASK_SERVICE_CONNECT_TIMEOUT_SECONDS", "5"))
+ASK_SERVICE_TIMEOUT_SECONDS = float(os.getenv("ASK_SERVICE_TIMEOUT_SECONDS", "180"))
+# Same for ChatCompletion calls without a timeout, periodic and batch calls may wait long for the LLM scheduler
+ASK_SERVICE_LLM_TIMEOUT_SECONDS = float(os.getenv("ASK_SERVICE_LLM_TIMEOUT_SECONDS", "900"))
+# How often a request rejected with 429 is retried before giving up
+ASK_SERVICE_RETRIES = int(os.getenv("ASK_SERVICE_RETRIES", "30"))
+
+
+def _post(path: str, data: Dict[str, Any], stream: bool = False, read_timeout: float = None) -> requests.Response:
+    """
+    Send a request to the ask service, requests rejected because the service is busy are retried.
+
+    Raises:
+    - requests.exceptions.Timeout: If the service does not answer within the timeouts.
+    - TimeoutError: If the service gave up waiting for a slot of its LLM scheduler.
+    """
+    headers = {"X-Client-Id": ASK_SERVICE_CLIENT_ID}
+    for attempt in range(ASK_SERVICE_RETRIES + 1):
+        response = requests.post(f"{ASK_SERVICE_URL}{path}", json=data, headers=headers, stream=stream,
+                                 timeout=(ASK_SERVICE_CONNECT_TIMEOUT_SECONDS, read_timeout or ASK_SERVICE_TIMEOUT_SECONDS))
+        if response.status_code != 429 or attempt == ASK_SERVICE_RETRIES:
+            break
+        wait = float(response.headers.get("Retry-After", "1"))
+        logger.info(f">>>>>> Ask service is busy, retry in {wait} seconds")
+        time.sleep(wait)
+    if response.status_code == 504:
+        raise TimeoutError(response.json().get("error"))
+    if response.status_code != 200:
+        raise ValueError(f"Error: {response.status_code} : {response.content}")
+    return response
+
+
+def ask(user_question: str, bearer_token_db: str = None, server_ip: str = None, max_context_tokens: int = None, source: str = "vector",
+        retrieval_settings: Dict[str, Any] = None, on_token: Callable[[str], None] = None,
+        deadline_seconds: float = None) -> str:
+    """
+    Same as chat_utils.ask, but answered by the ask service.
+
+    The bearer token and the server ip are configured in the service, they are only accepted here so the bots can
+    switch between both functions without changes.
+
+    Parameters:
+    - user_question (str): The user's input question.
+    - bearer_token_db (str, optional): Ignored.
+    - server_ip (str, optional): Ignored.
+    - max_context_tokens (int, optional): Token budget for extra info.
+    - source (str, optional): Data source type. Defaults to "vector".
+    - retrieval_settings (Dict[str, Any], optional): Overrides of the default retrieval settings.
+    - on_token (Callable[[str], None], optional): Receives the pieces of the answer while it is generated.
+    - deadline_seconds (float, optional): Time for the whole answer, the service default if not given.
+
+    Returns:
+    - str: The answer.
+    """
+    data = {"question": user_question, "max_context_tokens": max_context_tokens, "source": source,
+            "retrieval_settings": retrieval_settings, "deadline_seconds": deadline_seconds, "stream": on_token is not None}
+    response = _post("/ask", data, stream=on_token is not None)
+    if on_token is None:
+        return response.json()["answer"]
+
+    for line in response.iter_lines():
+        if not line:
+            continue
+        event = json.loads(line)
+        if "token" in event:
+            on_token(event["token"])
+        elif "answer" in event:
+            return event["answer"]
+        else:
+            raise ValueError(f"Error: {event.get('error')}")
+    raise ValueError("Error: the answer stream ended early")
+
+
+def query_database(query_prompt: str, bearer_token: str = None, server_ip: str = None, max_context_tokens: int = None,
+                   retrieval_settings: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+    """
+    Same as chat_utils.query_database, but answered by the ask service.
+    """
+    return _post("/query_database", {"query": query_prompt, "max_context_tokens": max_context_tokens,
+                                     "retrieval_settings": retrieval_settings}).json()["chunks"]
+
+
+def search_jsonl(search_text: str, max_context_tokens: int = None) -> List[Dict[str, Any]]:
+    """
+    Same as chat_utils.search_jsonl on the SharePoint JSONL file of the service, but answered by the ask service.
+    """
+    return _post("/search_jsonl", {"search_text": search_text, "max_context_tokens": max_context_tokens}).json()["chunks"]
+
+
+def chat_completion(messages: List[Dict[str, str]], engine: str, max_tokens: int, temperature: float = 0.3,
+                    on_token: Callable[[str], None] = None, timeout: float = None,
+                    priority: str = "interactive") -> Dict[str, Any]:
+    """
+    Same as chat_utils.create_chat_completion, but admitted by the LLM scheduler of the ask service, so the calls of
+    all processes share one queue and one rate limit.
+
+    Parameters:
+    - messages (List[Dict[str, str]]): The chat messages.
+    - engine (str): The OpenAI engine to use.
+    - max_tokens (int): The maximum number of tokens to generate.
+    - temperature (float, optional): The sampling temperature. Default is 0.3.
+    - on_token (Callable[[str], None], optional): Receives the pieces of the answer while it is generated.
+    - timeout (float, optional): Seconds the request may take including the wait for the scheduler.
+    - priority (str, optional): Priority class of the request. Defaults to "interactive".
+
+    Returns:
+    - Dict[str, Any]: The response from the API.
+
+    Raises:
+    - TimeoutError: If the scheduler of the service did not admit the request within the timeout.
+    """
+    data = {"messages": messages, "engine": engine, "max_tokens": max_tokens, "temperature": temperature,
+            "timeout": timeout, "priority": priority, "stream": on_token is not None}
+    read_timeout = timeout + ASK_SERVICE_CONNECT_TIMEOUT_SECONDS if timeout is not None else ASK_SERVICE_LLM_TIMEOUT_SECONDS
+    response = _post("/chat_completion", data, stream=on_token is not None, read_timeout=read_timeout)
+    if on_token is None:
+        return response.json()["response"]
+
+    for line in response.iter_lines():
+        if not line:
+            continue
+        event = json.loads(line)
+        if "token" in event:
+            on_token(event["token"])
+        elif "response" in event:
+            return event["response"]
+        else:
+            raise ValueError(f"Error: {event.get('error')}")
+    raise ValueError("Error: the answer stream ended early")
@@ -0,0 +1,341 @@
+import json
+import os
+import queue
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List
+
+import openai
+
+import chat_utils
+import tracing
+from cache_warming import CacheWarmer
+from chat_utils import ask, query_database, search_jsonl
+from llm_scheduler import PRIORITIES
+from log_config import configure_logging
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get_env_variable(var_name):
+    value = os.getenv(var_name)
+    if not value:
+        raise ValueError(f"Environment variable {var_name} is not set or is empty.")
+    return value
+
+
+class ServiceUnavailable(Exception):
+    """
+    Raised when a request is rejected by the admission control.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Job:
+
+    def __init__(self, function: Callable[..., Any], kwargs: Dict[str, Any], client_id: str, stream: bool):
+        self.function = function
+        self.kwargs = kwargs
+        self.client_id = client_id
+        self.enqueued = time.perf_counter()
+        # streamed answer pieces and the final ("result", value) or ("error", message) event
+        self.events = queue.Queue() if stream else None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AskService(ThreadingHTTPServer):
+    """
+    HTTP service answering questions with a shared worker pool, so all bots share one queue, one LLM rate limit
+    and the warm caches of this process.
+
+    - Requests wait in a bounded queue, a full queue is rejected immediately with 429.
+    - Every client (X-Client-Id header, otherwise the remote address) may only have a limited number of
+      requests queued or running, more are rejected with 429.
+    - On shutdown new requests are rejected with 503 while the queued and running requests (also the ChatCompletion
+      calls of other processes) are finished. Handler threads are not daemons, server_close() waits until every
+      response is written.
+    """
+
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, port: int, bearer_token: str, server_ip: str, workers: int = 4, queue_size: int = 16,
+                 client_concurrency: int = 2):
+        super().__init__(("127.0.0.1", port), _AskServiceHandler)
+        self.bearer_token = bearer_token
+        self.server_ip = server_ip
+        self.client_concurrency = client_concurrency
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.client_jobs = {}
+        # running /chat_completion calls, they bypass the job queue
+        self.llm_calls = 0
+        self.draining = False
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        tracing.register_gauge("ask_service_queue_length", self.jobs.qsize)
+
+    def submit(self, function: Callable[..., Any], kwargs: Dict[str, Any], client_id: str, stream: bool = False) -> _Job:
+        """
+        Admit a request into the queue or raise ServiceUnavailable.
+        """
+        job = _Job(function, kwargs, client_id, stream)
+        with self.lock:
+            if self.draining:
+                raise ServiceUnavailable(503, "Service is shutting down")
+            if self.client_jobs.get(client_id, 0) >= self.client_concurrency:
+                tracing.increment("ask_service_rejected_total", reason="client_limit")
+                raise ServiceUnavailable(429, f"Too many concurrent requests for client {client_id}")
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                tracing.increment("ask_service_rejected_total", reason="queue_full")
+                raise ServiceUnavailable(429, "Request queue is full")
+            self.client_jobs[client_id] = self.client_jobs.get(client_id, 0) + 1
+        return job
+
+    def start_llm_call(self) -> None:
+        """
+        Count a ChatCompletion call of another process as running or raise ServiceUnavailable while draining.
+        """
+        with self.lock:
+            if self.draining:
+                raise ServiceUnavailable(503, "Service is shutting down")
+            self.llm_calls += 1
+
+    def finish_llm_call(self) -> None:
+        with self.lock:
+            self.llm_calls -= 1
+
+    def _work(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            tracing.observe("ask_service_queue_wait_seconds", time.perf_counter() - job.enqueued)
+            try:
+                if job.events is not None:
+                    job.kwargs["on_token"] = lambda piece: job.events.put(("token", piece))
+                job.result = job.function(**job.kwargs)
+                if job.events is not None:
+                    job.events.put(("result", job.result))
+            except Exception as e:
+                logger.error(f"Request of client {job.client_id} failed: {e}")
+                job.error = str(e)
+                if job.events is not None:
+                    job.events.put(("error", job.error))
+            finally:
+                with self.lock:
+                    self.client_jobs[job.client_id] -= 1
+                    if not self.client_jobs[job.client_id]:
+                        del self.client_jobs[job.client_id]
+                job.done.set()
+                self.jobs.task_done()
+
+    def drain(self, timeout: float = 120) -> None:
+        """
+        Reject new requests, wait until the queued and running requests are finished and stop the server. The
+        responses still being written are awaited by server_close().
+
+        Parameters:
+        - timeout (float, optional): Maximum seconds to wait for running requests. Defaults to 120.
+        """
+        with self.lock:
+            self.draining = True
+        logger.info("Draining ask service")
+        end = time.monotonic() + timeout
+        while (self.jobs.unfinished_tasks or self.llm_calls) and time.monotonic() < end:
+            time.sleep(0.1)
+        for _ in self.workers:
+            self.jobs.put(None)
+        self.shutdown()
+        logger.info("Ask service stopped")
+
+
+class _AskServiceHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, status: int, data: Dict[str, Any], headers: Dict[str, str] = None) -> None:
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(503 if self.server.draining else 200, {"queued": self.server.jobs.qsize(), "draining": self.server.draining})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": "Request body is not valid JSON"})
+            return
+
+        service = self.server
+        if self.path == "/chat_completion":
+            self._chat_completion(body)
+            return
+        stream = False
+        try:
+            if self.path == "/ask":
+                function = ask
+                kwargs = {"user_question": body["question"], "bearer_token_db": service.bearer_token, "server_ip": service.server_ip,
+                          "max_context_tokens": body.get("max_context_tokens"), "source": body.get("source", "vector"),
+                          "retrieval_settings": body.get("retrieval_settings"), "deadline_seconds": body.get("deadline_seconds")}
+                stream = bool(body.get("stream"))
+            elif self.path == "/query_database":
+                function = query_database
+                kwargs = {"query_prompt": body["query"], "bearer_token": service.bearer_token, "server_ip": service.server_ip,
+                          "max_context_tokens": body.get("max_context_tokens"), "retrieval_settings": body.get("retrieval_settings")}
+            elif self.path == "/search_jsonl":
+                function = search_jsonl
+                kwargs = {"file_path": chat_utils.SHAREPOINT_JSONL_PATH, "search_text": body["search_text"]}
+                if body.get("max_context_tokens"):
+                    kwargs["max_context_tokens"] = body["max_context_tokens"]
+            else:
+                self.send_error(404)
+                return
+        except KeyError as e:
+            self._send_json(400, {"error": f"Missing field {e}"})
+            return
+
+        client_id = self.headers.get("X-Client-Id") or self.client_address[0]
+        try:
+            job = service.submit(function, kwargs, client_id, stream=stream)
+        except ServiceUnavailable as e:
+            self._send_json(e.status, {"error": str(e)}, headers={"Retry-After": "1"})
+            return
+
+        if stream:
+            self._stream(job)
+            return
+        job.done.wait()
+        if job.error is not None:
+            self._send_json(500, {"error": job.error})
+        elif function is ask:
+            self._send_json(200, {"answer": job.result})
+        else:
+            self._send_json(200, {"chunks": job.result})
+
+    def _chat_completion(self, body: Dict[str, Any]) -> None:
+        """
+        Run a ChatCompletion call of another process (see chat_utils.LLM_VIA_ASK_SERVICE). The call is admitted by the
+        LLM scheduler of this service like the calls of its own answers, it bypasses the worker pool and the client
+        limits. A streamed response is sent as JSON lines: {"token": ...}, then {"response": ...} or {"error": ...}.
+        """
+        try:
+            messages, engine, max_tokens = body["messages"], body["engine"], body["max_tokens"]
+        except KeyError as e:
+            self._send_json(400, {"error": f"Missing field {e}"})
+            return
+        priority = body.get("priority") or "interactive"
+        if priority not in PRIORITIES:
+            self._send_json(400, {"error": f"Unknown priority class: {priority}"})
+            return
+        try:
+            self.server.start_llm_call()
+        except ServiceUnavailable as e:
+            self._send_json(e.status, {"error": str(e)}, headers={"Retry-After": "1"})
+            return
+        try:
+            self._run_chat_completion(body, messages, engine, max_tokens, priority)
+        finally:
+            self.server.finish_llm_call()
+
+    def _run_chat_completion(self, body: Dict[str, Any], messages: List[Dict[str, str]], engine: str, max_tokens: int,
+                             priority: str) -> None:
+        started = False
+
+        def send_line(data: Dict[str, Any]) -> None:
+            nonlocal started
+            if not started:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                started = True
+            self.wfile.write((json.dumps(data) + "\n").encode())
+            self.wfile.flush()
+
+        on_token = (lambda piece: send_line({"token": piece})) if body.get("stream") else None
+        try:
+            response = chat_utils.create_chat_completion(messages, engine, max_tokens, body.get("temperature", 0.3),
+                                                         on_token=on_token, timeout=body.get("timeout"), priority=priority)
+        except Exception as e:
+            logger.warning(f">>>>>> ChatCompletion for {self.headers.get('X-Client-Id')} failed: {type(e).__name__}: {e}")
+            if started:
+                send_line({"error": f"{type(e).__name__}: {e}"})
+            else:
+                self._send_json(504 if isinstance(e, TimeoutError) else 502, {"error": f"{type(e).__name__}: {e}"})
+            return
+        if on_token is not None:
+            send_line({"response": response})
+        else:
+            self._send_json(200, {"response": response})
+
+    def _stream(self, job: _Job) -> None:
+        """
+        Send the answer as JSON lines: {"token": ...} while generating, then {"answer": ...} or {"error": ...}.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        while True:
+            kind, value = job.events.get()
+            key = "answer" if kind == "result" else kind
+            self.wfile.write((json.dumps({key: value}) + "\n").encode())
+            self.wfile.flush()
+            if kind != "token":
+                return
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main():
+    configure_logging('ask_service.log')
+    # this process runs the shared LLM scheduler, it must not send its calls to itself
+    chat_utils.LLM_VIA_ASK_SERVICE = False
+
+    openai.api_type = "azure"
+    openai.api_key = get_env_variable("OPENAI_API_KEY")
+    openai.api_base = get_env_variable('OPENAI_API_BASE')
+    openai.api_version = get_env_variable('OPENAI_API_VERSION')
+    tracing.start_metrics_server()
+
+    service = AskService(int(os.getenv("ASK_SERVICE_PORT", "8100")), get_env_variable("BEARER_TOKEN"), get_env_variable("SERVER_IP"),
+                         workers=int(os.getenv("ASK_SERVICE_WORKERS", "4")),
+                         queue_size=int(os.getenv("ASK_SERVICE_QUEUE_SIZE", "16")),
+                         client_concurrency=int(os.getenv("ASK_SERVICE_CLIENT_CONCURRENCY", "2")))
+
+    def stop(signum, frame):
+        # drain in another thread, shutdown() blocks until serve_forever has returned
+        threading.Thread(target=service.drain).start()
+
+    # answers the frequent questions of all bots while nobody asks
+    threading.Thread(target=CacheWarmer(get_env_variable("BEARER_TOKEN")).run, name="cache-warming-loop", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Ask service listening on http://127.0.0.1:{service.server_address[1]}")
+    service.serve_forever()
+    # joins the handler threads, so the last responses are written completely
+    service.server_close()
+
+
+if __name__ == "__main__":
+    main()
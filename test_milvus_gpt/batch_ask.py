@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List
+
+import openai
+
+from chat_utils import RERANK_CANDIDATE_FACTOR, answer_from_chunks, context_token_budget, query_database_batch, retrieve
+from llm_scheduler import llm_priority
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def read_questions(file_path: str) -> Iterable[Dict[str, Any]]:
+    """
+    Read the questions of a JSONL file, every line has a "question" and optionally an "id".
+
+    Parameters:
+    - file_path (str): Path of the file, "-" reads from stdin.
+
+    Returns:
+    - Iterable[Dict[str, Any]]: The questions with their "index" in the file.
+    """
+    file = sys.stdin if file_path == "-" else open(file_path, "r")
+    try:
+        index = 0
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record["index"] = index
+            index += 1
+            yield record
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def _batches(records: Iterable[Dict[str, Any]], batch_size: int) -> Iterable[List[Dict[str, Any]]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def retrieve_batch(records: List[Dict[str, Any]], source: str, bearer_token: str, server_ip: str,
+                   max_context_tokens: int = None, retrieval_settings: Dict[str, Any] = None) -> None:
+    """
+    Retrieve the candidate chunks of a batch of questions and store them in the records with the token budget of
+    their answer ("chunks", "budget", "timings").
+
+    Vector retrieval sends the whole batch in one /query request, the other sources retrieve per question. A failed
+    retrieval is stored as "error" of the records.
+    """
+    for record in records:
+        record["budget"] = max_context_tokens or context_token_budget(record["question"])
+    start = time.perf_counter()
+    if source == "vector":
+        try:
+            all_chunks = query_database_batch([record["question"] for record in records], bearer_token, server_ip,
+                                              max_context_tokens, retrieval_settings, candidate_factor=RERANK_CANDIDATE_FACTOR)
+        except Exception as e:
+            for record in records:
+                record["error"] = f"{type(e).__name__}: {e}"
+            return
+        duration = time.perf_counter() - start
+        for record, chunks in zip(records, all_chunks):
+            record["chunks"] = chunks
+            # the batch request is shared, every question waited for all of it
+            record["timings"] = {"retrieval": duration}
+        return
+
+    for record in records:
+        start = time.perf_counter()
+        try:
+            record["chunks"] = retrieve(record["question"], source, bearer_token, server_ip, record["budget"], retrieval_settings)
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["timings"] = {"retrieval": time.perf_counter() - start}
+
+
+def answer_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Generate the answer of a record with retrieved chunks and build its output line.
+    """
+    timings = record.get("timings", {})
+    output = {key: value for key, value in record.items() if key not in ("chunks", "budget", "timings", "error")}
+    output["chunk_ids"] = []
+    if "error" not in record:
+        start = time.perf_counter()
+        try:
+            output["answer"] = answer_from_chunks(record["question"], record["chunks"], timings=timings,
+                                                  max_context_tokens=record["budget"], chunk_ids=output["chunk_ids"])
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        timings["answer"] = time.perf_counter() - start
+    if "error" in record:
+        output["error"] = record["error"]
+    output["timings"] = {stage: round(seconds, 4) for stage, seconds in timings.items()}
+    return output
+
+
+def run_batch(records: Iterable[Dict[str, Any]], output_file, source: str, bearer_token: str, server_ip: str,
+              concurrency: int = 4, batch_size: int = 16, max_context_tokens: int = None,
+              retrieval_settings: Dict[str, Any] = None) -> Dict[str, int]:
+    """
+    Answer questions and write one JSON line per answer as soon as it is ready.
+
+    Retrieval runs batch by batch while the answers of the previous batches are generated by `concurrency` workers.
+    All LLM calls run in the "batch" priority class, so interactive answers of the same process go first.
+
+    Parameters:
+    - records (Iterable[Dict[str, Any]]): The questions, see read_questions.
+    - output_file: Text file the JSON lines are written to.
+    - source (str): "vector", "direct_search" or "collections".
+    - bearer_token (str): Token for database authentication.
+    - server_ip (str): IP address of the retrieval plugin.
+    - concurrency (int, optional): Number of answers generated in parallel. Defaults to 4.
+    - batch_size (int, optional): Number of questions per /query request. Defaults to 16.
+    - max_context_tokens (int, optional): Token budget of the chunks, defaults to the budget of every question.
+    - retrieval_settings (Dict[str, Any], optional): Overrides of DEFAULT_RETRIEVAL_SETTINGS.
+
+    Returns:
+    - Dict[str, int]: Number of answered and failed questions.
+    """
+    lock = threading.Lock()
+    counts = {"answered": 0, "failed": 0}
+
+    def answer_and_write(record):
+        with llm_priority("batch"):
+            output = answer_record(record)
+        with lock:
+            output_file.write(json.dumps(output, ensure_ascii=False) + "\n")
+            output_file.flush()
+            counts["failed" if "error" in output else "answered"] += 1
+
+    # bounded queue of retrieved questions, retrieval stays at most two batches ahead of the answers
+    submitted = threading.BoundedSemaphore(concurrency + 2 * batch_size)
+
+    def release(future):
+        submitted.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch in _batches(records, batch_size):
+            with llm_priority("batch"):
+                retrieve_batch(batch, source, bearer_token, server_ip, max_context_tokens, retrieval_settings)
+            for record in batch:
+                submitted.acquire()
+                executor.submit(answer_and_write, record).add_done_callback(release)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions ({\"question\": ...} per line) and "
+                                                 "write the answers, chunk ids and stage timings as JSON lines.")
+    parser.add_argument("questions", help="JSONL file with the questions, - reads from stdin")
+    parser.add_argument("--output", default="-", help="JSONL file for the answers, - writes to stdout")
+    parser.add_argument("--concurrency", type=int, default=4, help="Answers generated in parallel")
+    parser.add_argument("--batch-size", type=int, default=16, help="Questions per /query request")
+    parser.add_argument("--source", default="vector", choices=["vector", "direct_search", "collections"])
+    parser.add_argument("--max-context-tokens", type=int, default=None)
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    with open(args.config) as config_file:
+        config_details = json.load(config_file)
+    openai.api_type = "azure"
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    openai.api_base = config_details['OPENAI_API_BASE']
+    openai.api_version = config_details['OPENAI_API_VERSION']
+
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    start = time.perf_counter()
+    try:
+        counts = run_batch(read_questions(args.questions), output_file, args.source, os.environ['BEARER_TOKEN'],
+                           config_details['SERVER_IP'], args.concurrency, args.batch_size, args.max_context_tokens,
+                           config_details.get('RETRIEVAL'))
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+    print(f"Answered {counts['answered']} questions ({counts['failed']} failed) in {time.perf_counter() - start:.1f} seconds",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+import chat_utils
+import tracing
+from answer_cache import QUESTION_STATS_SAVE_SECONDS, corpus_version
+from llm_scheduler import llm_priority
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Number of the most frequent questions kept answered in the cache, 0 turns warming off
+WARM_TOP_N = int(os.getenv("WARM_TOP_N", "20"))
+# Questions asked less often than this (decayed count, see answer_cache.QuestionStats) are not warmed, the default
+# warms questions asked at least twice recently
+WARM_MIN_SCORE = float(os.getenv("WARM_MIN_SCORE", "1.5"))
+# Warming only starts when no user asked a question for this long
+WARM_IDLE_SECONDS = float(os.getenv("WARM_IDLE_SECONDS", "120"))
+# Time between two warm-up runs when the corpus did not change
+WARM_INTERVAL_SECONDS = float(os.getenv("WARM_INTERVAL_SECONDS", "1800"))
+# Cached answers older than this share of their time to live (see answer_cache) are answered again before they expire
+WARM_REFRESH_SHARE = float(os.getenv("WARM_REFRESH_SHARE", "0.75"))
+
+
+class CacheWarmer:
+    """
+    Keeps the answers of the most frequent questions in the answer cache of chat_utils. Every question is answered
+    again with the source and settings it was asked with (see chat_utils.question_stats).
+
+    The bots call idle() instead of sleeping in their poll loops. When the bot was idle for WARM_IDLE_SECONDS and the
+    last run is WARM_INTERVAL_SECONDS ago or a corpus file changed, a background thread answers the top questions that
+    have no fresh cached answer. The LLM calls run in the "batch" priority class and a run stops as soon as a user
+    asks a question, so warming never delays a chat answer. idle() also writes the question frequencies to their
+    file every QUESTION_STATS_SAVE_SECONDS.
+    """
+
+    def __init__(self, bearer_token: str, top_n: int = WARM_TOP_N, min_score: float = WARM_MIN_SCORE,
+                 idle_seconds: float = WARM_IDLE_SECONDS, interval_seconds: float = WARM_INTERVAL_SECONDS):
+        self.bearer_token = bearer_token
+        self.top_n = top_n
+        self.min_score = min_score
+        self.idle_seconds = idle_seconds
+        self.interval_seconds = interval_seconds
+        self.last_run = None
+        self.last_corpus_version = None
+        self.last_save = time.monotonic()
+        self.thread = None
+
+    def due(self) -> bool:
+        """
+        Whether a warm-up run should start now.
+        """
+        if not self.top_n or (self.thread is not None and self.thread.is_alive()):
+            return False
+        if chat_utils.seconds_since_last_question() < self.idle_seconds:
+            return False
+        if self.last_run is None or corpus_version(chat_utils.answer_cache.corpus_paths) != self.last_corpus_version:
+            return True
+        return time.monotonic() - self.last_run >= self.interval_seconds
+
+    def idle(self, seconds: float) -> None:
+        """
+        Sleep for the poll interval of a bot, starting a warm-up run in the background if one is due.
+        """
+        if time.monotonic() - self.last_save >= QUESTION_STATS_SAVE_SECONDS:
+            self.last_save = time.monotonic()
+            chat_utils.question_stats.save()
+        if self.due():
+            self.thread = threading.Thread(target=self.warm, name="cache-warming", daemon=True)
+            self.thread.start()
+        time.sleep(seconds)
+
+    def run(self, poll_seconds: float = 30) -> None:
+        """
+        Check for idle times forever, for services without a poll loop.
+        """
+        while True:
+            self.idle(poll_seconds)
+
+    def warm(self) -> int:
+        """
+        Answer the most frequent questions that have no fresh answer in the cache.
+
+        Returns:
+        - int: Number of answered questions.
+        """
+        self.last_run = time.monotonic()
+        self.last_corpus_version = corpus_version(chat_utils.answer_cache.corpus_paths)
+        warmed = 0
+        with tracing.span("cache_warming") as attributes, llm_priority("batch"):
+            for question, arguments in chat_utils.question_stats.top(self.top_n, self.min_score):
+                if chat_utils.seconds_since_last_question() < self.idle_seconds:
+                    logger.info(">>>>>> Stop cache warming, a user is asking")
+                    break
+                key = chat_utils.question_key(question, arguments["source"], arguments["max_context_tokens"],
+                                              arguments["server_ip"], arguments["retrieval_settings"])
+                used_share = chat_utils.answer_cache.used_share(key)
+                if used_share is not None and used_share < WARM_REFRESH_SHARE:
+                    continue
+                try:
+                    chat_utils.ask(question, self.bearer_token, arguments["server_ip"], arguments["max_context_tokens"],
+                                   arguments["source"], arguments["retrieval_settings"], refresh=True)
+                except Exception as e:
+                    logger.warning(f">>>>>> Could not warm the answer of {question}: {type(e).__name__}: {e}")
+                    tracing.increment("cache_warming_errors_total")
+                    continue
+                warmed += 1
+                tracing.increment("cache_warming_answers_total")
+            attributes.update(warmed=warmed)
+        chat_utils.question_stats.save()
+        if warmed:
+            logger.info(f">>>>>> Warmed the answers of {warmed} frequent questions")
+        return warmed
@@ -23,4 +23,4 @@ if __name__ == "__main__":
         # openai.api_base = open_ai_api_base
         logging.basicConfig(level=logging.WARNING,
                             format="%(asctime)s %(levelname)s %(message)s")
-        print(ask(user_query, bearer_token_db))
\ No newline at end of file
+        print(ask(user_query, bearer_token_db, config_details['SERVER_IP'], retrieval_settings=config_details.get('RETRIEVAL')))
\ No newline at end of file
@@ -1,10 +1,204 @@
 import json
-from typing import Any, List, Dict
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import Any, Callable, List, Dict
 import openai
 import requests
 
+import ask_client
+import tracing
+from answer_cache import ANSWER_CACHE_VECTOR_TTL_SECONDS, AnswerCache, QuestionStats
+from corpus import open_corpus
+from llm_scheduler import current_priority, scheduler
+from log_config import Truncated, sample_chunks
+from rerank import rerank
+from resilience import CircuitBreaker, CircuitOpenError, Deadline
+
 import logging
 logger = logging.getLogger(__name__)
+# Texts of the retrieved chunks, sampled (LOG_CHUNK_SAMPLE_RATE) and truncated, e.g. LOG_LEVELS=chat_utils.chunks=WARNING
+# turns them off
+chunk_logger = logging.getLogger(f"{__name__}.chunks")
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken is optional, without it (or without its cached vocabulary) the token count is estimated
+    _encoding = None
+# Name of the token counting, stored with the precomputed token counts of compiled corpora
+TOKENIZER = "cl100k_base" if _encoding is not None else "estimate"
+
+_token_pattern = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Context window sizes of the deployments, the answer tokens and the prompt are subtracted from these.
+MODEL_CONTEXT_TOKENS = {
+    "kai-gpt-16k-model": 16384,
+    "gpt-35-turbo-version0301": 4096,
+}
+ANSWER_MAX_TOKENS = 800
+# Tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+CONTEXT_SAFETY_MARGIN_TOKENS = 200
+# Retrieval for an answer returns candidates of up to this many times the token budget, the reranker chooses from all
+# of them and only its choice is packed into the budget (see answer_from_chunks)
+RERANK_CANDIDATE_FACTOR = float(os.getenv("RERANK_CANDIDATE_FACTOR", "3"))
+
+# Context compaction: chunks sharing this fraction of their word shingles are treated as near-duplicates
+SHINGLE_SIZE = 5
+NEAR_DUPLICATE_SIMILARITY = 0.8
+CONTEXT_DELIMITER = "\n-----\n"
+_chunk_number_pattern = re.compile(r"^(.*)_(\d+)$")
+
+# Single-flight: callers asking the same normalized question while it is answered wait for that answer instead of
+# starting their own retrieval and LLM calls. More waiters than this compute their own answer.
+SINGLE_FLIGHT_MAX_WAITERS = int(os.getenv("SINGLE_FLIGHT_MAX_WAITERS", "16"))
+_bot_mention_pattern = re.compile(r"^@?phat\s?gpt\b[\s:,]*", re.IGNORECASE)
+_in_flight_lock = threading.Lock()
+# key -> {"future": Future, "waiters": int, "refresh": bool}
+_in_flight = {}
+
+# Send the ChatCompletion calls to the ask service (ask_client.chat_completion) instead of calling Azure directly, so
+# one LLM scheduler admits the calls of all bots and jobs on the machine. Never set for the ask service itself.
+LLM_VIA_ASK_SERVICE = os.getenv("LLM_VIA_ASK_SERVICE", "0") == "1"
+
+# Answers of questions asked before or precomputed by cache_warming, and how often every question is asked
+answer_cache = AnswerCache()
+question_stats = QuestionStats()
+# Time of the last question asked by a user, cache warming waits for idle times
+_last_question_time = 0.0
+
+RETRIEVAL_PLUGIN_PORT = int(os.getenv("RETRIEVAL_PLUGIN_PORT", "8000"))
+# Timeout of a /query request that has no deadline
+RETRIEVAL_TIMEOUT_SECONDS = float(os.getenv("RETRIEVAL_TIMEOUT_SECONDS", "30"))
+SHAREPOINT_JSONL_PATH = os.getenv("SHAREPOINT_JSONL_PATH", "/home/azureuser/phat_sharepoint.jsonl")
+
+# Deadline of an answer: retrieval may use RETRIEVAL_DEADLINE_SHARE of it, generation the rest. A second /query
+# request is sent when the first has not answered after RETRIEVAL_HEDGE_SHARE of the retrieval time.
+ASK_DEADLINE_SECONDS = float(os.getenv("ASK_DEADLINE_SECONDS", "60"))
+RETRIEVAL_DEADLINE_SHARE = float(os.getenv("RETRIEVAL_DEADLINE_SHARE", "0.3"))
+RETRIEVAL_HEDGE_SHARE = float(os.getenv("RETRIEVAL_HEDGE_SHARE", "0.5"))
+# Answer of ask when the deadline ran out or no source could be reached, the bots post it and go on with the next message
+ASK_ERROR_MESSAGE = ("Es tut mir leid, die Antwort hat zu lange gedauert oder die Datenquellen sind gerade nicht erreichbar. "
+                     "Bitte versuche es spaeter noch einmal.")
+_retrieval_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+_plugin_breakers_lock = threading.Lock()
+# port -> CircuitBreaker of the retrieval plugin on that port
+_plugin_breakers = {}
+
+# Adaptive vector retrieval, every frontend can override single values (see load_retrieval_settings).
+# Scores are the similarity returned by the retrieval plugin, higher is better.
+DEFAULT_RETRIEVAL_SETTINGS = {
+    # number of candidates requested from the plugin
+    "top_k": 22,
+    # candidates requested when the best score is below weak_score
+    "max_top_k": 50,
+    "weak_score": 0.78,
+    # candidates below this score are dropped (except the best min_results)
+    "min_score": 0.7,
+    # the candidates are cut at the largest score gap if it is at least this large
+    "min_score_gap": 0.04,
+    # the best this many candidates are always kept, whatever their score
+    "min_results": 3,
+}
+
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(text: str) -> int:
+    """
+    Count the tokens of a text locally, results are cached per text.
+
+    Uses the cl100k_base tokenizer of the chat models when tiktoken is installed. Otherwise words are counted with
+    one token per 3 characters (at least one) and every punctuation character as one token, which overestimates
+    German text slightly, so budgets computed with it stay below the real limit.
+
+    Parameters:
+    - text (str): The text to estimate.
+
+    Returns:
+    - int: The estimated number of tokens.
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    tokens = 0
+    for match in _token_pattern.finditer(text):
+        tokens += max(1, (len(match.group(0)) + 2) // 3)
+    return tokens
+
+
+tracing.register_gauge("token_count_cache_hits", lambda: estimate_tokens.cache_info().hits)
+tracing.register_gauge("token_count_cache_misses", lambda: estimate_tokens.cache_info().misses)
+tracing.register_gauge("ask_in_flight_questions", lambda: len(_in_flight))
+tracing.register_gauge("ask_coalesced_waiters", lambda: sum(flight["waiters"] for flight in list(_in_flight.values())))
+
+
+def context_token_budget(user_question: str, engine: str = "kai-gpt-16k-model", max_tokens: int = ANSWER_MAX_TOKENS) -> int:
+    """
+    Compute how many tokens of extra information fit into a request for the given question.
+
+    Parameters:
+    - user_question (str): The user's input question.
+    - engine (str, optional): The OpenAI engine used for the answer. Default is "kai-gpt-16k-model".
+    - max_tokens (int, optional): Tokens reserved for the answer. Default is ANSWER_MAX_TOKENS.
+
+    Returns:
+    - int: The token budget for the chunks.
+    """
+    context_tokens = MODEL_CONTEXT_TOKENS.get(engine, 4096)
+    prompt_tokens = estimate_tokens(apply_prompt_template(user_question)) + MESSAGE_OVERHEAD_TOKENS
+    return max(0, context_tokens - max_tokens - prompt_tokens - CONTEXT_SAFETY_MARGIN_TOKENS)
+
+
+def make_chunk(chunk_id: str, text: str, **fields) -> Dict[str, Any]:
+    """
+    Create a chunk dictionary with its precomputed token count.
+
+    Parameters:
+    - chunk_id (str): Id of the chunk in its source.
+    - text (str): Text of the chunk.
+    - **fields: Additional fields stored in the chunk (e.g. score), "tokens" replaces the token count of the text.
+
+    Returns:
+    - Dict[str, Any]: The chunk with "id", "text" and "tokens".
+    """
+    tokens = fields.pop("tokens", None)
+    chunk = {"id": chunk_id, "text": text, "tokens": estimate_tokens(text) if tokens is None else tokens}
+    chunk.update(fields)
+    return chunk
+
+
+def pack_chunks(chunks: List[Dict[str, Any]], max_context_tokens: int, source: str = "") -> List[Dict[str, Any]]:
+    """
+    Take chunks in rank order until the next chunk does not fit into the token budget anymore.
+
+    Parameters:
+    - chunks (List[Dict[str, Any]]): Chunks created with make_chunk, best chunk first.
+    - max_context_tokens (int): The token budget for all chunks.
+    - source (str, optional): Name of the source, only used for logging.
+
+    Returns:
+    - List[Dict[str, Any]]: The chunks that fit into the budget.
+    """
+    packed = []
+    token_counter = 0
+    log_texts = chunk_logger.isEnabledFor(logging.INFO) and sample_chunks()
+    for chunk in chunks:
+        token_counter += chunk["tokens"] + MESSAGE_OVERHEAD_TOKENS
+        if token_counter > max_context_tokens:
+            break
+        if log_texts:
+            chunk_logger.info(">>>>>> Add following info to question from %s: %s", source, Truncated(chunk["text"]))
+        packed.append(chunk)
+    logger.info(">>>>>> Add %d chunks from %s: %s", len(packed), source, ", ".join(str(chunk["id"]) for chunk in packed))
+    tracing.annotate(chunks=len(packed), context_tokens=sum(chunk["tokens"] for chunk in packed))
+    tracing.increment("retrieval_chunks_total", len(packed), source=source)
+    return packed
 
 
 def apply_prompt_template(question: str) -> str:
@@ -18,7 +212,68 @@ def apply_prompt_template(question: str) -> str:
     """
     return prompt
 
-def call_chatgpt_api_user_promt_system_prompt(user_prompt: str, system_prompt: str = None, engine: str = "kai-gpt-16k-model") -> Dict[str, Any]:
+def create_chat_completion(messages: List[Dict[str, str]], engine: str, max_tokens: int, temperature: float = 0.3,
+                           on_token: Callable[[str], None] = None, timeout: float = None,
+                           priority: str = None) -> Dict[str, Any]:
+    """
+    Send a ChatCompletion request through the shared LLM scheduler and record its duration and token usage. With
+    LLM_VIA_ASK_SERVICE the request is admitted by the scheduler of the ask service instead of the one of this process.
+
+    Parameters:
+    - messages (List[Dict[str, str]]): The chat messages.
+    - engine (str): The OpenAI engine to use.
+    - max_tokens (int): The maximum number of tokens to generate.
+    - temperature (float, optional): The sampling temperature. Default is 0.3.
+    - on_token (Callable[[str], None], optional): If given the answer is streamed and every piece of text is passed
+                                                  to this function as soon as it arrives.
+    - timeout (float, optional): Seconds the request may take including the wait for the scheduler, no limit if not
+                                 given.
+    - priority (str, optional): Priority class of the request ("interactive", "periodic" or "batch"). Defaults to
+                                the class of this thread, see llm_scheduler.llm_priority.
+
+    Returns:
+    - Dict[str, Any]: The response from the API, a streamed answer is assembled into the same format.
+
+    Raises:
+    - TimeoutError: If the scheduler did not admit the request within the timeout.
+    """
+    priority = priority or current_priority()
+    with tracing.span("llm", engine=engine, max_tokens=max_tokens, stream=on_token is not None,
+                      priority=priority) as attributes:
+        if LLM_VIA_ASK_SERVICE:
+            response = ask_client.chat_completion(messages, engine, max_tokens, temperature, on_token=on_token,
+                                                  timeout=timeout, priority=priority)
+            attributes.update(tracing.record_llm_usage(response, engine), via_ask_service=True)
+            return response
+        start = time.monotonic()
+        with scheduler.slot(priority, timeout=timeout):
+            if timeout is not None:
+                # the wait for the slot counts against the timeout
+                timeout = max(0.1, timeout - (time.monotonic() - start))
+            response = openai.ChatCompletion.create(
+                engine=engine,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=on_token is not None,
+                **({"request_timeout": timeout} if timeout is not None else {}),
+            )
+            if on_token is not None:
+                pieces = []
+                for chunk in response:
+                    if not chunk["choices"]:
+                        continue
+                    piece = chunk["choices"][0].get("delta", {}).get("content")
+                    if piece:
+                        pieces.append(piece)
+                        on_token(piece)
+                response = {"choices": [{"message": {"role": "assistant", "content": "".join(pieces)}}]}
+        attributes.update(tracing.record_llm_usage(response, engine))
+    return response
+
+
+def call_chatgpt_api_user_promt_system_prompt(user_prompt: str, system_prompt: str = None, engine: str = "kai-gpt-16k-model", max_tokens: int = 8000,
+                                              priority: str = None) -> Dict[str, Any]:
     """
     Call chatgpt API with a user prompt and an optional system prompt.
     
@@ -26,6 +281,8 @@ def call_chatgpt_api_user_promt_system_prompt(user_prompt: str, system_prompt: s
     - user_prompt (str): The user's question or input to ask the model.
     - system_prompt (str, optional): An optional system message to prepend before the user's input. Default is None.
     - engine (str, optional): The OpenAI engine to use for the API call. Default is "kai-gpt-16k-model".
+    - max_tokens (int, optional): The maximum number of tokens to generate. Default is 8000.
+    - priority (str, optional): Priority class of the request, defaults to the class of this thread.
     
     Returns:
     - Dict[str, Any]: The response from the GPT-3 API.
@@ -38,86 +295,490 @@ def call_chatgpt_api_user_promt_system_prompt(user_prompt: str, system_prompt: s
     messages.append({"role": "user", "content": user_prompt})
     
     try:
-        response = openai.ChatCompletion.create(
-            engine=engine,
-            messages=messages,
-            max_tokens=8000,
-            temperature=0.3,
-        )
-        return response
+        return create_chat_completion(messages, engine, max_tokens, priority=priority)
     except Exception as e:
         # Handle the exception as required, for now, just printing it
         logger.error(f"Error occurred: {e}")
         raise e
 
 
-def call_chatgpt_api(user_question: str, chunks: List[str] = None, engine: str = "kai-gpt-16k-model") -> Dict[str, Any]:
+def call_chatgpt_api(user_question: str, chunks: List[str] = None, engine: str = "kai-gpt-16k-model",
+                     on_token: Callable[[str], None] = None, timeout: float = None) -> Dict[str, Any]:
     """
     Call chatgpt API with user's question and retrieved chunks.
     
     Parameters:
     - user_question (str): The user's question to ask the model.
-    - chunks (List[str], optional): A list of context chunks to prepend before the user's question.
+    - chunks (List[str], optional): A list of context chunks, sent as one delimited message before the user's question.
+    - on_token (Callable[[str], None], optional): Receives the streamed pieces of the answer.
+    - timeout (float, optional): Seconds the request may take.
     
     Returns:
     - Dict[str, Any]: The response from the GPT-3 API.
     """
     
-    messages = [{"role": "user", "content": chunk} for chunk in (chunks or [])]
+    # All chunks are sent as one delimited context block instead of one message per chunk
+    messages = [{"role": "user", "content": CONTEXT_DELIMITER.join(chunks)}] if chunks else []
     messages.append({"role": "user", "content": user_question})
     
     try:
-        response = openai.ChatCompletion.create(
-            engine=engine,
-            messages=messages,
-            max_tokens=800,
-            temperature=0.3,
-        )
-        return response
+        return create_chat_completion(messages, engine, ANSWER_MAX_TOKENS, on_token=on_token, timeout=timeout)
     except Exception as e:
         # Handle the exception as required, for now, just printing it
         logger.error(f"Error occurred: {e}")
         raise e
 
 
-def ask(user_question: str, bearer_token_db: str, server_ip: str, max_characters_extra_info = 16000, source: str = "vector") -> Dict[str, Any]:
+def _split_chunk_id(chunk: Dict[str, Any]):
+    """
+    Return the source id and the chunk number of a chunk, e.g. ("Kai_Luenstaeden", 3) for "Kai_Luenstaeden_3".
+    """
+    match = _chunk_number_pattern.match(chunk["id"] or "")
+    if match:
+        return chunk.get("source_id") or match.group(1), int(match.group(2))
+    return chunk.get("source_id") or chunk["id"], None
+
+
+def _shingles(text: str) -> set:
+    words = text.lower().split()
+    if len(words) <= SHINGLE_SIZE:
+        return {hash(tuple(words))}
+    return {hash(tuple(words[i:i + SHINGLE_SIZE])) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def compact_chunks(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Remove near-duplicate chunks and merge neighbouring chunks of the same source.
+
+    - A chunk whose word shingles overlap with a better ranked chunk by at least NEAR_DUPLICATE_SIMILARITY
+      (Jaccard similarity) is dropped.
+    - Chunks of the same source with consecutive chunk numbers are merged into the better ranked one, so they are
+      sent in reading order under a single source header.
+
+    Parameters:
+    - chunks (List[Dict[str, Any]]): Chunks in rank order, as returned by query_database or search_jsonl.
+
+    Returns:
+    - List[Dict[str, Any]]: The compacted chunks in rank order with "source_id" and "text".
+    """
+    kept = []
+    kept_shingles = []
+    for chunk in chunks:
+        shingles = _shingles(chunk["text"])
+        if any(len(shingles & other) / len(shingles | other) >= NEAR_DUPLICATE_SIMILARITY for other in kept_shingles):
+            logger.info(f">>>>>> Drop near-duplicate chunk {chunk['id']}")
+            continue
+        kept.append(chunk)
+        kept_shingles.append(shingles)
+
+    merged = []
+    # (source id, chunk number) -> merged group containing that chunk
+    groups_by_number = {}
+    for chunk in kept:
+        source_id, number = _split_chunk_id(chunk)
+        group = None
+        if number is not None:
+            group = groups_by_number.get((source_id, number - 1)) or groups_by_number.get((source_id, number + 1))
+        if group is None:
+            group = {"source_id": source_id, "parts": []}
+            merged.append(group)
+        group["parts"].append((number if number is not None else 0, chunk["text"]))
+        if number is not None:
+            groups_by_number[(source_id, number)] = group
+
+    return [{"source_id": group["source_id"], "text": "\n".join(text for _, text in sorted(group["parts"], key=lambda part: part[0]))}
+            for group in merged]
+
+
+@tracing.traced("prompt_build")
+def build_context_block(chunks: List[Dict[str, Any]]) -> List[str]:
+    """
+    Compact the retrieved chunks and format them with their source for the context block of call_chatgpt_api.
+
+    Logs how many prompt tokens the compaction saved compared to sending every chunk as its own message.
+
+    Parameters:
+    - chunks (List[Dict[str, Any]]): Chunks in rank order, as returned by query_database or search_jsonl.
+
+    Returns:
+    - List[str]: The formatted context parts.
+    """
+    compacted = compact_chunks(chunks)
+    context_parts = [f"Quelle: {chunk['source_id']}\n{chunk['text']}" for chunk in compacted]
+
+    tokens_before = sum(chunk["tokens"] + MESSAGE_OVERHEAD_TOKENS for chunk in chunks)
+    tokens_after = estimate_tokens(CONTEXT_DELIMITER.join(context_parts)) + MESSAGE_OVERHEAD_TOKENS
+    logger.info(f">>>>>> Context compaction: {len(chunks)} chunks -> {len(compacted)} parts, "
+                f"{tokens_before} -> {tokens_after} tokens (saved {tokens_before - tokens_after})")
+    tracing.annotate(parts=len(compacted), tokens_before=tokens_before, tokens_after=tokens_after)
+    tracing.increment("context_tokens_saved_total", tokens_before - tokens_after)
+    return context_parts
+
+
+def group_chunks_by_tokens(chunks: List[str], max_tokens_per_group: int) -> List[List[str]]:
+    """
+    Split chunks into consecutive groups whose estimated token count stays below a budget.
+
+    A single chunk larger than the budget forms its own group.
+
+    Parameters:
+    - chunks (List[str]): The chunks to group, the order is kept.
+    - max_tokens_per_group (int): Token budget of a group.
+
+    Returns:
+    - List[List[str]]: The groups of chunks.
+    """
+    groups = []
+    current_group = []
+    current_tokens = 0
+    for chunk in chunks:
+        chunk_tokens = estimate_tokens(chunk)
+        if current_group and current_tokens + chunk_tokens > max_tokens_per_group:
+            groups.append(current_group)
+            current_group = []
+            current_tokens = 0
+        current_group.append(chunk)
+        current_tokens += chunk_tokens
+    if current_group:
+        groups.append(current_group)
+    return groups
+
+
+def map_reduce_summarize(chunks: List[str], system_prompt: str, reduce_system_prompt: str = None, max_tokens_per_group: int = 6000,
+                         map_max_tokens: int = 1500, reduce_max_tokens: int = 4000, max_workers: int = 4,
+                         engine: str = "kai-gpt-16k-model") -> str:
+    """
+    Summarize chunks that may not fit into one request with a hierarchical map-reduce.
+
+    - Groups the chunks by a token budget.
+    - Summarizes the groups in parallel (map), all calls go through the LLM scheduler in the priority class of the
+      calling thread.
+    - Merges the partial summaries (reduce), repeated while the partial summaries do not fit into one group.
+
+    If all chunks fit into one group only one call is made, exactly like calling
+    call_chatgpt_api_user_promt_system_prompt with the joined chunks (with its default max_tokens, reduce_max_tokens
+    only limits the final call after a map pass).
+
+    Parameters:
+    - chunks (List[str]): The text chunks to summarize.
+    - system_prompt (str): System prompt used for the single call and the map calls.
+    - reduce_system_prompt (str, optional): System prompt used to merge partial summaries. Defaults to the system prompt
+                                            with an additional instruction to merge partial summaries.
+    - max_tokens_per_group (int, optional): Input token budget of one call. Defaults to 6000.
+    - map_max_tokens (int, optional): Maximum tokens generated for one partial summary. Defaults to 1500.
+    - reduce_max_tokens (int, optional): Maximum tokens generated for the final summary. Defaults to 4000.
+    - max_workers (int, optional): Number of groups summarized in parallel. Defaults to 4.
+    - engine (str, optional): The OpenAI engine to use. Default is "kai-gpt-16k-model".
+
+    Returns:
+    - str: The summary.
+    """
+    if reduce_system_prompt is None:
+        reduce_system_prompt = (f"{system_prompt}\n[INPUT]\nThe input consists of partial summaries of consecutive parts of the "
+                                "comments, separated by '=====' lines. Merge them into one summary and do not repeat comments.")
+
+    # the map calls run in worker threads, which do not inherit the priority class of this thread
+    priority = current_priority()
+    groups = group_chunks_by_tokens(chunks, max_tokens_per_group)
+    if len(groups) <= 1:
+        response = call_chatgpt_api_user_promt_system_prompt(''.join(chunks), system_prompt, engine=engine)
+        return response["choices"][0]["message"]["content"]
+
+    def summarize_group(group: List[str], prompt: str) -> str:
+        response = call_chatgpt_api_user_promt_system_prompt(''.join(group), prompt, engine=engine, max_tokens=map_max_tokens,
+                                                             priority=priority)
+        return response["choices"][0]["message"]["content"]
+
+    logger.info(f">>>>>> Summarize {len(chunks)} chunks in {len(groups)} groups")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        partial_summaries = list(executor.map(lambda group: summarize_group(group, system_prompt), groups))
+
+        # Merge partial summaries level by level until they fit into one final call
+        groups = group_chunks_by_tokens([f"{summary}\n=====\n" for summary in partial_summaries], max_tokens_per_group)
+        while 1 < len(groups) < len(partial_summaries):
+            logger.info(f">>>>>> Merge {len(partial_summaries)} partial summaries in {len(groups)} groups")
+            partial_summaries = list(executor.map(lambda group: summarize_group(group, reduce_system_prompt), groups))
+            groups = group_chunks_by_tokens([f"{summary}\n=====\n" for summary in partial_summaries], max_tokens_per_group)
+
+    response = call_chatgpt_api_user_promt_system_prompt(''.join(chunk for group in groups for chunk in group), reduce_system_prompt, engine=engine, max_tokens=reduce_max_tokens)
+    return response["choices"][0]["message"]["content"]
+
+
+def normalize_question(user_question: str) -> str:
+    """
+    Normalize a question for comparing it with other questions.
+
+    Removes a leading mention of the bot, case, repeated whitespace and trailing punctuation, so
+    "@PhatGpt  Wer ist Kai?" and "phatgpt wer ist kai" are the same question.
+
+    Parameters:
+    - user_question (str): The user's input question.
+
+    Returns:
+    - str: The normalized question.
+    """
+    question = " ".join(user_question.split())
+    question = _bot_mention_pattern.sub("", question)
+    return question.casefold().rstrip("?!. ")
+
+
+def question_key(user_question: str, source: str, max_context_tokens: int, server_ip: str,
+                 retrieval_settings: Dict[str, Any] = None) -> tuple:
+    """
+    Key of a question for coalescing and caching: questions with the same key get the same answer.
+    """
+    return (normalize_question(user_question), source, max_context_tokens, server_ip,
+            json.dumps(retrieval_settings or {}, sort_keys=True))
+
+
+def seconds_since_last_question() -> float:
+    """
+    Seconds since a user asked the last question, infinite while no question was asked. 0 while a question is being
+    answered.
+    """
+    with _in_flight_lock:
+        if any(not flight["refresh"] for flight in _in_flight.values()):
+            return 0.0
+    return time.monotonic() - _last_question_time if _last_question_time else float("inf")
+
+
+@tracing.traced("ask")
+def ask(user_question: str, bearer_token_db: str, server_ip: str, max_context_tokens: int = None, source: str = "vector",
+        retrieval_settings: Dict[str, Any] = None, on_token: Callable[[str], None] = None,
+        deadline_seconds: float = None, refresh: bool = False) -> str:
     """
     Handles user questions, queries a database, and generates responses using ChatGPT.
 
-    - Queries the database with the user's question.
-    - Logs the user's question and the retrieved chunks.
-    - Calls ChatGPT with the question and chunks to generate a response.
-    - Logs and returns the first generated response.
+    Answers are cached (see answer_cache.AnswerCache), a cached answer is returned without retrieval and is passed
+    to on_token as one piece. Only answers retrieved from the requested source are cached.
+
+    Identical questions (see normalize_question) with the same source and settings that arrive while the question is
+    being answered share one computation, at most SINGLE_FLIGHT_MAX_WAITERS callers wait for it. A waiting caller
+    with on_token receives the whole answer as one piece. A user question never waits for a refresh, whose LLM calls
+    run at a lower priority, it is answered on its own and identical questions wait for it instead.
 
     Parameters:
     - user_question (str): The user's input question.
     - bearer_token_db (str): Token for database authentication.
     - server_ip (str): IP address of the server.
-    - max_characters_extra_info (int, optional): Maximum character limit for extra info. Defaults to 16000.
-    - source (str, optional): Data source type. Defaults to "vector".
+    - max_context_tokens (int, optional): Token budget for extra info. Defaults to the context size of the model
+                                          minus the answer tokens and the prompt.
+    - source (str, optional): Data source type, "vector", "direct_search" or "collections". Defaults to "vector".
+    - retrieval_settings (Dict[str, Any], optional): Overrides of DEFAULT_RETRIEVAL_SETTINGS for vector retrieval.
+    - on_token (Callable[[str], None], optional): Receives the pieces of the answer while it is generated.
+    - deadline_seconds (float, optional): Time for the whole answer, see _answer. Defaults to ASK_DEADLINE_SECONDS.
+    - refresh (bool, optional): Answer again instead of using the cache and do not count the question as asked,
+                                used by cache_warming. Defaults to False.
 
     Returns:
-    - Dict[str, Any]: Contains the generated response in "choices"[0]["message"]["content"].
+    - str: The generated answer.
     """
-    chunks = ""
-    if source == "vector":
-        # Get chunks from database.
-        chunks = query_database(user_question, bearer_token_db, server_ip, max_characters_extra_info=max_characters_extra_info)
+    global _last_question_time
+    key = question_key(user_question, source, max_context_tokens, server_ip, retrieval_settings)
+    if not refresh:
+        _last_question_time = time.monotonic()
+        question_stats.record(json.dumps(key), user_question,
+                              {"source": source, "max_context_tokens": max_context_tokens, "server_ip": server_ip,
+                               "retrieval_settings": retrieval_settings})
+        answer = answer_cache.get(key)
+        if answer is not None:
+            logger.info(">>>>>> %s User's questions: %s", source, user_question)
+            logger.info(">>>>>> Answer from the cache")
+            tracing.annotate(cached=True)
+            if on_token is not None:
+                on_token(answer)
+            return answer
+
+    with _in_flight_lock:
+        flight = _in_flight.get(key)
+        if flight is None or (flight["refresh"] and not refresh):
+            flight = _in_flight[key] = {"future": Future(), "waiters": 0, "refresh": refresh}
+            leader = True
+        elif flight["waiters"] < SINGLE_FLIGHT_MAX_WAITERS:
+            flight["waiters"] += 1
+            leader = False
+        else:
+            flight = None
+
+    if flight is None:
+        tracing.increment("ask_single_flight_total", outcome="waiters_full")
+        return _answer(user_question, bearer_token_db, server_ip, max_context_tokens, source, retrieval_settings, on_token,
+                       deadline_seconds)
+
+    if not leader:
+        tracing.increment("ask_single_flight_total", outcome="coalesced")
+        tracing.annotate(coalesced=True)
+        logger.info(">>>>>> Wait for the answer of the identical question in progress: %s", user_question)
+        answer = flight["future"].result()
+        if on_token is not None:
+            on_token(answer)
+        return answer
+
+    tracing.increment("ask_single_flight_total", outcome="computed")
+    outcome = {}
+    try:
+        answer = _answer(user_question, bearer_token_db, server_ip, max_context_tokens, source, retrieval_settings, on_token,
+                         deadline_seconds, outcome)
+        if outcome.get("source") == source and outcome.get("chunks"):
+            # the vector database changes through the plugin without a file to watch, its answers live shorter
+            answer_cache.put(key, answer, ANSWER_CACHE_VECTOR_TTL_SECONDS if source in ("vector", "collections") else None)
+    except BaseException as e:
+        flight["future"].set_exception(e)
+        raise
     else:
-        keywords = ask_direct_search(user_question)
-        logger.info(f">>>>>> The keywords for direct search are: {keywords}")
-        chunks = search_jsonl("/home/azureuser/phat_sharepoint.jsonl", keywords, max_characters_extra_info=max_characters_extra_info)
+        flight["future"].set_result(answer)
+    finally:
+        with _in_flight_lock:
+            # a user question may have taken over the key from a refresh
+            if _in_flight.get(key) is flight:
+                del _in_flight[key]
+        if flight["waiters"]:
+            tracing.observe("ask_single_flight_waiters", flight["waiters"])
+    return answer
+
 
-    logger.info(f">>>>>> {source} User's questions: {user_question}")
-    logger.info(f">>>>>> {source} Use {len(chunks)} chunks")
+def _answer(user_question: str, bearer_token_db: str, server_ip: str, max_context_tokens: int = None, source: str = "vector",
+            retrieval_settings: Dict[str, Any] = None, on_token: Callable[[str], None] = None,
+            deadline_seconds: float = None, outcome: Dict[str, Any] = None) -> str:
+    """
+    Answer one question without coalescing.
+
+    - Retrieves chunks from the source within RETRIEVAL_DEADLINE_SHARE of the deadline, falling back to the other
+      source if it fails or times out.
+    - Logs the user's question.
+    - Generates the answer from the chunks within the remaining time (see answer_from_chunks).
+    - Returns ASK_ERROR_MESSAGE instead of raising when the deadline runs out or both sources fail.
+
+    The source the chunks came from and their number are stored in outcome ("source", "chunks") if given, the outcome
+    stays empty for ASK_ERROR_MESSAGE.
+    """
+    deadline = Deadline(deadline_seconds or ASK_DEADLINE_SECONDS)
+    if max_context_tokens is None:
+        max_context_tokens = context_token_budget(user_question)
+    answer_outcome = {}
+    try:
+        answer = _answer_within(user_question, bearer_token_db, server_ip, max_context_tokens, source, retrieval_settings,
+                                on_token, deadline, answer_outcome)
+    except (TimeoutError, openai.error.Timeout, CircuitOpenError, requests.exceptions.RequestException) as e:
+        logger.error(f">>>>>> Could not answer {user_question}: {type(e).__name__}: {e}")
+        tracing.increment("ask_errors_total", error=type(e).__name__)
+        tracing.annotate(error=type(e).__name__)
+        return ASK_ERROR_MESSAGE
+    if outcome is not None:
+        outcome.update(answer_outcome)
+    return answer
+
+
+def _answer_within(user_question: str, bearer_token_db: str, server_ip: str, max_context_tokens: int, source: str,
+                   retrieval_settings: Dict[str, Any], on_token: Callable[[str], None], deadline: Deadline,
+                   outcome: Dict[str, Any]) -> str:
+    """
+    Retrieve with the source fallback and generate the answer within the deadline, see _answer.
+    """
+    sources = [source, "vector" if source == "direct_search" else "direct_search"]
+    for attempt, current_source in enumerate(sources):
+        try:
+            chunks = retrieve(user_question, current_source, bearer_token_db, server_ip, max_context_tokens,
+                              retrieval_settings, deadline.share(RETRIEVAL_DEADLINE_SHARE))
+            break
+        except Exception as e:
+            if attempt == len(sources) - 1:
+                raise
+            logger.warning(f">>>>>> {current_source} retrieval failed ({type(e).__name__}: {e}), fall back to {sources[attempt + 1]}")
+            tracing.increment("retrieval_fallback_total", source=current_source, fallback=sources[attempt + 1])
+            tracing.annotate(fallback=sources[attempt + 1])
+
+    logger.info(">>>>>> %s User's questions: %s", source, user_question)
+    tracing.annotate(source=current_source)
+    outcome.update(source=current_source, chunks=len(chunks))
+    return answer_from_chunks(user_question, chunks, on_token=on_token, timeout=deadline.remaining(),
+                              max_context_tokens=max_context_tokens)
+
+
+def answer_from_chunks(user_question: str, chunks: List[Dict[str, Any]], on_token: Callable[[str], None] = None,
+                       timeout: float = None, timings: Dict[str, float] = None, max_context_tokens: int = None,
+                       chunk_ids: List[str] = None) -> str:
+    """
+    Generate the answer to a question from retrieved chunks.
+
+    - Reranks the chunks locally and keeps the best ones (see rerank.rerank).
+    - Packs the reranked chunks into the token budget if one is given.
+    - Calls ChatGPT with the question and the compacted chunks.
+
+    Parameters:
+    - user_question (str): The user's input question.
+    - chunks (List[Dict[str, Any]]): The retrieved chunks.
+    - on_token (Callable[[str], None], optional): Receives the pieces of the answer while it is generated.
+    - timeout (float, optional): Seconds the ChatCompletion call may take.
+    - timings (Dict[str, float], optional): Filled with the seconds of the "rerank", "prompt_build" and "llm" stages.
+    - max_context_tokens (int, optional): Token budget of the chunks, for candidates retrieved with
+                                          RERANK_CANDIDATE_FACTOR times the budget (see retrieve).
+    - chunk_ids (List[str], optional): Filled with the ids of the chunks the answer is generated from.
+
+    Returns:
+    - str: The answer.
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    chunks = rerank(user_question, chunks)
+    if max_context_tokens is not None:
+        chunks = pack_chunks(chunks, max_context_tokens, source="Rerank")
+    if chunk_ids is not None:
+        chunk_ids.extend(chunk["id"] for chunk in chunks)
+    timings["rerank"] = time.perf_counter() - start
+    logger.info(f">>>>>> Use {len(chunks)} chunks")
+    tracing.annotate(chunks=len(chunks))
     if(len(chunks) == 0):
         return "Es konnten keine Informationen zu dieser Frage gefunden werden."
-    
-    response = call_chatgpt_api(apply_prompt_template(user_question), chunks)
+
+    start = time.perf_counter()
+    context_parts = build_context_block(chunks)
+    timings["prompt_build"] = time.perf_counter() - start
+    start = time.perf_counter()
+    response = call_chatgpt_api(apply_prompt_template(user_question), context_parts, on_token=on_token, timeout=timeout)
+    timings["llm"] = time.perf_counter() - start
 
     return response["choices"][0]["message"]["content"]
 
-def ask_direct_search(user_question: str) -> str:
+
+def retrieve(user_question: str, source: str, bearer_token_db: str, server_ip: str, max_context_tokens: int,
+             retrieval_settings: Dict[str, Any] = None, deadline: Deadline = None) -> List[Dict[str, Any]]:
+    """
+    Retrieve the chunks for a question from one source.
+
+    Parameters:
+    - user_question (str): The user's input question.
+    - source (str): "vector" for the retrieval plugin, "collections" for the collections chosen by the router (see
+                    retrieval_collections), otherwise direct search in the SharePoint JSONL file.
+    - bearer_token_db (str): Token for database authentication.
+    - server_ip (str): IP address of the server.
+    - max_context_tokens (int): Token budget for the chunks of the answer. RERANK_CANDIDATE_FACTOR times as many
+                                tokens are retrieved, pass the budget to answer_from_chunks to pack the reranked
+                                chunks into it.
+    - retrieval_settings (Dict[str, Any], optional): Overrides of DEFAULT_RETRIEVAL_SETTINGS for vector retrieval.
+    - deadline (Deadline, optional): Deadline of the retrieval.
+
+    Returns:
+    - List[Dict[str, Any]]: The candidate chunks in rank order.
+
+    Raises:
+    - TimeoutError: If the deadline is exceeded.
+    """
+    candidate_tokens = int(max_context_tokens * RERANK_CANDIDATE_FACTOR)
+    if source == "vector":
+        return query_database(user_question, bearer_token_db, server_ip, max_context_tokens=candidate_tokens,
+                              retrieval_settings=retrieval_settings, deadline=deadline)
+    if source == "collections":
+        # imported here, retrieval_collections builds on this module
+        from retrieval_collections import retrieve_collections
+        return retrieve_collections(user_question, bearer_token_db, server_ip, candidate_tokens, deadline=deadline,
+                                    retrieval_settings=retrieval_settings)
+    keywords = ask_direct_search(user_question, deadline=deadline)
+    logger.info(">>>>>> The keywords for direct search are: %s", keywords)
+    return search_jsonl(SHAREPOINT_JSONL_PATH, keywords, max_context_tokens=candidate_tokens)
+
+@tracing.traced("keyword_extraction")
+def ask_direct_search(user_question: str, deadline: Deadline = None) -> str:
     """
     Handles user questions using ChatGPT for direct keyword extraction.
 
@@ -127,84 +788,350 @@ def ask_direct_search(user_question: str) -> str:
 
     Parameters:
     - user_question (str): The user's input question.
+    - deadline (Deadline, optional): Deadline of the keyword extraction.
 
     Returns:
     - str: Contains the extracted keywords or information
     """
     logger.info(">>>>>> User's questions: %s", user_question)
     response = call_chatgpt_api(f"""{user_question} ---- 
-        antworte mit ja oder nein (ein wort): wird oben nach einer person bei namen gefragt?""")["choices"][0]["message"]["content"]
+        antworte mit ja oder nein (ein wort): wird oben nach einer person bei namen gefragt?""",
+        timeout=_remaining(deadline))["choices"][0]["message"]["content"]
     if "ja" in response.lower():
         return call_chatgpt_api(f"""{user_question} ----
-            helfe mir aus der frage oben nur den namen zu schreiben""")["choices"][0]["message"]["content"]
+            helfe mir aus der frage oben nur den namen zu schreiben""", timeout=_remaining(deadline))["choices"][0]["message"]["content"]
     return call_chatgpt_api(f"""{user_question} ----
-        schreibe nur ein wort oder woerter: was sind die wichtigsten woerter in diesem satz oben?""")["choices"][0]["message"]["content"]
+        schreibe nur ein wort oder woerter: was sind die wichtigsten woerter in diesem satz oben?""",
+        timeout=_remaining(deadline))["choices"][0]["message"]["content"]
+
 
-def query_database(query_prompt: str, bearer_token: str, server_ip: str, max_characters_extra_info: int = 16000) -> List[str]:
+def _remaining(deadline: Deadline = None) -> float:
     """
-    Queries a vector database and retrieves relevant text chunks based on the user's input.
+    Seconds left of a deadline, None without a deadline.
+
+    Raises:
+    - TimeoutError: If the deadline has passed.
+    """
+    if deadline is None:
+        return None
+    if deadline.expired():
+        raise TimeoutError("Deadline exceeded")
+    return deadline.remaining()
+
+def load_retrieval_settings(overrides: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Merge the retrieval settings of a frontend with DEFAULT_RETRIEVAL_SETTINGS.
 
     Parameters:
-    - query_prompt (str): The user's input question or prompt for querying.
+    - overrides (Dict[str, Any], optional): Values that differ from the defaults, e.g. the "RETRIEVAL" section of
+                                            config.json.
+
+    Returns:
+    - Dict[str, Any]: The complete retrieval settings.
+
+    Raises:
+    - ValueError: If an unknown setting is given.
+    """
+    settings = dict(DEFAULT_RETRIEVAL_SETTINGS)
+    for key, value in (overrides or {}).items():
+        if key not in settings:
+            raise ValueError(f"Unknown retrieval setting: {key}")
+        settings[key] = value
+    return settings
+
+
+def select_by_score(results: List[Dict[str, Any]], settings: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Cut plugin results at the score threshold and at the largest score gap. The best min_results results are always
+    kept, so a question whose results all score low is still answered from its closest matches.
+
+    Parameters:
+    - results (List[Dict[str, Any]]): Results of the retrieval plugin, best first.
+    - settings (Dict[str, Any]): The retrieval settings.
+
+    Returns:
+    - List[Dict[str, Any]]: The selected results.
+    """
+    results = sorted(results, key=lambda result: result.get("score") or 0, reverse=True)
+    selected = results[:settings["min_results"]] + [result for result in results[settings["min_results"]:]
+                                                     if (result.get("score") or 0) >= settings["min_score"]]
+    if len(selected) <= settings["min_results"]:
+        return selected
+
+    scores = [result.get("score") or 0 for result in selected]
+    gaps = [(scores[i - 1] - scores[i], i) for i in range(settings["min_results"], len(scores))]
+    largest_gap, cut = max(gaps)
+    if largest_gap >= settings["min_score_gap"]:
+        return selected[:cut]
+    return selected
+
+
+def _score_distribution(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    scores = sorted((result.get("score") or 0 for result in results), reverse=True)
+    if not scores:
+        return {"count": 0}
+    return {
+        "count": len(scores),
+        "max": round(scores[0], 4),
+        "median": round(scores[len(scores) // 2], 4),
+        "min": round(scores[-1], 4),
+    }
+
+
+def plugin_breaker(port: int) -> CircuitBreaker:
+    """
+    Return the circuit breaker of the retrieval plugin on a port, every plugin fails independently.
+    """
+    with _plugin_breakers_lock:
+        breaker = _plugin_breakers.get(port)
+        if breaker is None:
+            breaker = _plugin_breakers[port] = CircuitBreaker(f"retrieval_plugin_{port}", CIRCUIT_FAILURE_THRESHOLD,
+                                                              CIRCUIT_RESET_SECONDS)
+        return breaker
+
+
+def post_queries(queries: List[Dict[str, Any]], bearer_token: str, server_ip: str,
+                 timeout: float = None, port: int = None) -> List[List[Dict[str, Any]]]:
+    """
+    Send queries to the /query endpoint of the retrieval plugin in one request.
+
+    The request goes through the circuit breaker of the plugin, while the plugin keeps failing it is not called at all.
+
+    Parameters:
+    - queries (List[Dict[str, Any]]): Queries with "query" and "top_k".
     - bearer_token (str): Authentication token for the database.
     - server_ip (str): IP address of the database server.
-    - max_characters_extra_info (int, optional): Max character limit for the combined chunks. Defaults to 16000.
+    - timeout (float, optional): Seconds the request may take. Defaults to RETRIEVAL_TIMEOUT_SECONDS.
+    - port (int, optional): Port of the retrieval plugin. Defaults to RETRIEVAL_PLUGIN_PORT.
 
     Returns:
-    - List[str]: List of retrieved text chunks.
+    - List[List[Dict[str, Any]]]: The results of every query, in the order of the queries.
 
     Raises:
     - ValueError: If there's an error in the database response.
+    - CircuitOpenError: If the plugin failed too often and is not called.
+    - requests.Timeout: If the plugin does not answer in time.
     """
-    url = f"http://{server_ip}:8000/query"
+    port = port or RETRIEVAL_PLUGIN_PORT
+    breaker = plugin_breaker(port)
+    url = f"http://{server_ip}:{port}/query"
     headers = {
         "Content-Type": "application/json",
         "accept": "application/json",
         "Authorization": f"Bearer {bearer_token}",
     }
-    data = {"queries": [{"query": query_prompt, "top_k": 22}]}
-
-    response = requests.post(url, json=data, headers=headers)
+    breaker.before_call()
+    try:
+        response = requests.post(url, json={"queries": queries}, headers=headers,
+                                 timeout=RETRIEVAL_TIMEOUT_SECONDS if timeout is None else timeout)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
 
     if response.status_code == 200:
-        result = response.json()
-
-        chunks = []
-        char_counter = 0
-        for result in result["results"]:
-            for inner_result in result["results"]:
-                innter_text = inner_result["text"]
-                char_counter = char_counter + len(innter_text)
-                if char_counter > max_characters_extra_info:
-                    continue
-                logger.info(f">>>>>> Add following info to question from Milvus: {innter_text}")
-                chunks.append(innter_text)
-
-        # process the result
-        return chunks
+        breaker.record_success()
+        return [result["results"] for result in response.json()["results"]]
     else:
+        breaker.record_failure()
         raise ValueError(f"Error: {response.status_code} : {response.content}")
 
-def search_jsonl(file_path: str, search_text: str, max_characters_extra_info: int = 16000) -> List[str]:
+
+def post_queries_hedged(queries: List[Dict[str, Any]], bearer_token: str, server_ip: str,
+                        deadline: Deadline, port: int = None) -> List[List[Dict[str, Any]]]:
+    """
+    Send queries like post_queries, but send them a second time if the first request is slow.
+
+    The second request is sent after RETRIEVAL_HEDGE_SHARE of the time left, the first answer of both is used.
+
+    Parameters:
+    - queries (List[Dict[str, Any]]): Queries with "query" and "top_k".
+    - bearer_token (str): Authentication token for the database.
+    - server_ip (str): IP address of the database server.
+    - deadline (Deadline): Deadline of both requests.
+    - port (int, optional): Port of the retrieval plugin. Defaults to RETRIEVAL_PLUGIN_PORT.
+
+    Returns:
+    - List[List[Dict[str, Any]]]: The results of every query, in the order of the queries.
+
+    Raises:
+    - TimeoutError: If no request answered before the deadline.
+    """
+    timeout = _remaining(deadline)
+    futures = [_retrieval_executor.submit(post_queries, queries, bearer_token, server_ip, timeout, port)]
+    done, _ = wait(futures, timeout=timeout * RETRIEVAL_HEDGE_SHARE)
+    if not done:
+        logger.info(">>>>>> Retrieval plugin is slow, send a hedged request")
+        tracing.increment("retrieval_hedged_requests_total")
+        try:
+            futures.append(_retrieval_executor.submit(post_queries, queries, bearer_token, server_ip, _remaining(deadline), port))
+        except (TimeoutError, CircuitOpenError):
+            pass
+
+    error = None
+    pending = futures
+    while pending:
+        done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    if error is not None:
+        raise error
+    raise TimeoutError(f"Retrieval plugin did not answer within {timeout:.1f} seconds")
+
+
+@tracing.traced("retrieval.vector")
+def query_database(query_prompt: str, bearer_token: str, server_ip: str, max_context_tokens: int = None,
+                   retrieval_settings: Dict[str, Any] = None, deadline: Deadline = None,
+                   port: int = None) -> List[Dict[str, Any]]:
+    """
+    Queries a vector database and retrieves relevant text chunks based on the user's input.
+
+    - Requests "top_k" candidates, or "max_top_k" candidates when the best score is below "weak_score" and the
+      deadline leaves time for a second request.
+    - Cuts the candidates at the score threshold and at the largest score gap.
+    - Logs the effective k and the score distribution of the query.
+
+    Parameters:
+    - query_prompt (str): The user's input question or prompt for querying.
+    - bearer_token (str): Authentication token for the database.
+    - server_ip (str): IP address of the database server.
+    - max_context_tokens (int, optional): Token budget for the combined chunks. Defaults to the budget of the
+                                          16k model for this question.
+    - retrieval_settings (Dict[str, Any], optional): Overrides of DEFAULT_RETRIEVAL_SETTINGS.
+    - deadline (Deadline, optional): Deadline of the retrieval, slow requests are hedged (see post_queries_hedged).
+    - port (int, optional): Port of the retrieval plugin. Defaults to RETRIEVAL_PLUGIN_PORT.
+
+    Returns:
+    - List[Dict[str, Any]]: List of retrieved chunks in rank order with "id", "text", "tokens" and "score".
+
+    Raises:
+    - ValueError: If there's an error in the database response.
+    - TimeoutError: If the deadline is exceeded.
+    """
+    def send(queries):
+        if deadline is None:
+            return post_queries(queries, bearer_token, server_ip, port=port)
+        return post_queries_hedged(queries, bearer_token, server_ip, deadline, port=port)
+
+    settings = load_retrieval_settings(retrieval_settings)
+    top_k = settings["top_k"]
+    started = time.monotonic()
+    results = send([{"query": query_prompt, "top_k": top_k}])[0]
+
+    best_score = max((result.get("score") or 0 for result in results), default=0)
+    enough_time = deadline is None or deadline.remaining() > time.monotonic() - started
+    if best_score < settings["weak_score"] and settings["max_top_k"] > top_k and enough_time:
+        # weak matches, a wider candidate set gives the score cut more to choose from
+        top_k = settings["max_top_k"]
+        results = send([{"query": query_prompt, "top_k": top_k}])[0]
+
+    return _chunks_from_results(query_prompt, results, top_k, settings, max_context_tokens)
+
+
+def query_database_batch(query_prompts: List[str], bearer_token: str, server_ip: str, max_context_tokens: int = None,
+                         retrieval_settings: Dict[str, Any] = None, candidate_factor: float = 1.0) -> List[List[Dict[str, Any]]]:
+    """
+    Same as query_database for many questions, sent to the retrieval plugin in one /query request.
+
+    The questions with weak matches are sent again with "max_top_k" in a second request.
+
+    Parameters:
+    - query_prompts (List[str]): The questions.
+    - bearer_token (str): Authentication token for the database.
+    - server_ip (str): IP address of the database server.
+    - max_context_tokens (int, optional): Token budget of the chunks of every question. Defaults to the budget of
+                                          the 16k model for the question.
+    - retrieval_settings (Dict[str, Any], optional): Overrides of DEFAULT_RETRIEVAL_SETTINGS.
+    - candidate_factor (float, optional): The chunks of every question fill this many times its budget, e.g.
+                                          RERANK_CANDIDATE_FACTOR for candidates of answer_from_chunks. Defaults to 1.
+
+    Returns:
+    - List[List[Dict[str, Any]]]: The chunks of every question, in the order of the questions.
+    """
+    settings = load_retrieval_settings(retrieval_settings)
+    top_ks = [settings["top_k"]] * len(query_prompts)
+    all_results = post_queries([{"query": query_prompt, "top_k": settings["top_k"]} for query_prompt in query_prompts],
+                               bearer_token, server_ip)
+
+    weak = [i for i, results in enumerate(all_results)
+            if max((result.get("score") or 0 for result in results), default=0) < settings["weak_score"]]
+    if weak and settings["max_top_k"] > settings["top_k"]:
+        wider_results = post_queries([{"query": query_prompts[i], "top_k": settings["max_top_k"]} for i in weak],
+                                     bearer_token, server_ip)
+        for i, results in zip(weak, wider_results):
+            all_results[i] = results
+            top_ks[i] = settings["max_top_k"]
+
+    return [_chunks_from_results(query_prompt, results, top_k, settings,
+                                 int((max_context_tokens or context_token_budget(query_prompt)) * candidate_factor))
+            for query_prompt, results, top_k in zip(query_prompts, all_results, top_ks)]
+
+
+def _chunks_from_results(query_prompt: str, results: List[Dict[str, Any]], top_k: int, settings: Dict[str, Any],
+                         max_context_tokens: int = None) -> List[Dict[str, Any]]:
+    """
+    Select the plugin results of a question by score and pack them into its token budget.
+    """
+    selected = select_by_score(results, settings)
+    stats = {"requested_k": top_k, "effective_k": len(selected), "candidates": _score_distribution(results),
+             "selected": _score_distribution(selected)}
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(">>>>>> Retrieval stats: %s", json.dumps(stats))
+    tracing.annotate(**stats)
+
+    if max_context_tokens is None:
+        max_context_tokens = context_token_budget(query_prompt)
+
+    chunks = []
+    for inner_result in selected:
+        metadata = inner_result.get("metadata") or {}
+        chunks.append(make_chunk(inner_result["id"], inner_result["text"], score=inner_result.get("score"),
+                                 source_id=metadata.get("document_id"), source="vector"))
+
+    return pack_chunks(chunks, max_context_tokens, source="Milvus")
+
+@tracing.traced("retrieval.direct_search")
+def search_jsonl(file_path: str, search_text: str, max_context_tokens: int = 12000) -> List[Dict[str, Any]]:
     """
     Search for words in a .jsonl file and return matching entries.
+
+    Uses the compiled corpus of the file if there is an up to date one (see corpus.py), otherwise every line of the
+    file is parsed.
     
     Parameters:
     - file_path (str): Path to the .jsonl file.
     - search_text (str): Words to search for, separated by spaces. Special characters 
                          (ä, ü, ö, ß) are replaced with (ae, ue, oe, ss).
-    - max_characters_extra_info (int, optional): Maximum combined character limit for returned entries. 
-                                                 Defaults to 16000.
+    - max_context_tokens (int, optional): Token budget for the returned entries. Defaults to 12000.
     
     Returns:
-    - List[str]: List of entries sorted by the number of search words matched in descending order. 
-                 The total character count of the list will be below the 'max_characters_extra_info' threshold.
+    - List[Dict[str, Any]]: List of chunks sorted by the number of search words matched in descending order. 
+                            The total token count of the list will be below the 'max_context_tokens' threshold.
     """
     search_text = search_text.lower().replace('ä', 'ae').replace('ü', 'ue').replace('ö', 'oe').replace('ß', 'ss')
     search_words = [word.strip() for word in search_text.replace(",", "").replace('"', '').split()]
-    
-    entries_with_counts = []
 
+    corpus = open_corpus(file_path)
+    if corpus is not None:
+        tracing.annotate(compiled=True)
+        match_counts = corpus.count_matches(search_words)
+        sorted_chunks = []
+        token_counter = 0
+        # entries in file order first, so entries with the same count keep the order of the JSONL search
+        for index, match_count in sorted(sorted(match_counts.items()), key=lambda item: item[1], reverse=True):
+            text = corpus.text(index)
+            tokens = corpus.tokens[index] if corpus.tokenizer == TOKENIZER else estimate_tokens(text)
+            sorted_chunks.append(make_chunk(corpus.id(index), text, tokens=tokens, score=match_count, source="direct_search"))
+            token_counter += tokens + MESSAGE_OVERHEAD_TOKENS
+            if token_counter > max_context_tokens:
+                # pack_chunks stops here anyway, the remaining entries are not decoded
+                break
+        return pack_chunks(sorted_chunks, max_context_tokens, source="Direct Search")
+
+    entries_with_counts = []
     with open(file_path, 'r') as file:
         for line in file:
             entry = json.loads(line)
@@ -221,15 +1148,7 @@ def search_jsonl(file_path: str, search_text: str, max_characters_extra_info: in
             if match_count:
                 entries_with_counts.append((entry, match_count))
     
-    sorted_texts = [entry["text"] for entry, _ in sorted(entries_with_counts, key=lambda x: x[1], reverse=True)]
-    
-    final_texts = []
-    char_counter = 0
-    for text in sorted_texts:
-        char_counter += len(text)
-        if char_counter > max_characters_extra_info:
-            break
-        final_texts.append(text)
-        logger.info(f">>>>>> Add following info to question from Direct Search: {text}")
+    sorted_chunks = [make_chunk(entry.get("id", ""), entry["text"], score=match_count, source="direct_search")
+                     for entry, match_count in sorted(entries_with_counts, key=lambda x: x[1], reverse=True)]
                 
-    return final_texts
\ No newline at end of file
+    return pack_chunks(sorted_chunks, max_context_tokens, source="Direct Search")
\ No newline at end of file
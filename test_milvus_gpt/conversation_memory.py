@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+import tracing
+from chat_utils import call_chatgpt_api_user_promt_system_prompt, estimate_tokens
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Turns kept word for word, older turns are folded into the summary
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", "3"))
+# The recent turns are folded earlier if they get longer than this
+MEMORY_RECENT_MAX_TOKENS = int(os.getenv("MEMORY_RECENT_MAX_TOKENS", "1500"))
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "300"))
+# Conversations without a new question for this long are forgotten
+MEMORY_IDLE_SECONDS = float(os.getenv("MEMORY_IDLE_SECONDS", "1800"))
+MEMORY_MAX_CONVERSATIONS = int(os.getenv("MEMORY_MAX_CONVERSATIONS", "500"))
+
+REWRITE_SYSTEM_PROMPT = """Du bekommst den bisherigen Verlauf eines Gespraechs und eine neue Frage.
+Formuliere die neue Frage so um, dass sie ohne den Verlauf verstaendlich ist (Namen und Themen ausschreiben statt "er", "das", "dort").
+Ist sie das schon, gib sie unveraendert zurueck. Antworte nur mit der Frage."""
+
+SUMMARY_SYSTEM_PROMPT = """Du fasst Gespraeche zwischen einem Benutzer und einem Assistenten zusammen.
+Fuehre die bisherige Zusammenfassung und die neuen Gespraechsrunden zu einer kurzen Zusammenfassung zusammen.
+Behalte Namen, Themen und offene Fragen, lasse Details der Antworten weg."""
+
+
+def _format_turns(turns) -> str:
+    return "\n".join(f"Frage: {turn['question']}\nAntwort: {turn['answer']}" for turn in turns)
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    words = text.split()
+    while words and estimate_tokens(" ".join(words)) > max_tokens:
+        words = words[:int(len(words) * 0.9)]
+    return " ".join(words)
+
+
+class ConversationMemory:
+    """
+    Remembers the recent turns of every conversation of a bot so follow-up questions can be answered.
+
+    - The last MEMORY_RECENT_TURNS turns are kept word for word, older turns are folded into a rolling summary of at
+      most MEMORY_SUMMARY_MAX_TOKENS tokens, so the memory of a conversation never grows.
+    - Follow-up questions are rewritten into a standalone question that is used for retrieval and answer.
+    - Conversations are forgotten after MEMORY_IDLE_SECONDS without a question, at most MEMORY_MAX_CONVERSATIONS
+      are kept (the least recently used are forgotten first).
+    """
+
+    def __init__(self, recent_turns: int = MEMORY_RECENT_TURNS, summary_max_tokens: int = MEMORY_SUMMARY_MAX_TOKENS,
+                 idle_seconds: float = MEMORY_IDLE_SECONDS, max_conversations: int = MEMORY_MAX_CONVERSATIONS):
+        self.recent_turns = recent_turns
+        self.summary_max_tokens = summary_max_tokens
+        self.idle_seconds = idle_seconds
+        self.max_conversations = max_conversations
+        self.lock = threading.Lock()
+        # key -> {"summary": str, "turns": [{"question", "answer"}], "last_used": float}, least recently used first
+        self.conversations = OrderedDict()
+        tracing.register_gauge("conversation_memory_conversations", lambda: len(self.conversations))
+
+    def evict_idle(self) -> int:
+        """
+        Forget the conversations that were idle for too long and the least recently used ones above
+        max_conversations.
+
+        Returns:
+        - int: Number of forgotten conversations.
+        """
+        evicted = 0
+        now = time.monotonic()
+        with self.lock:
+            while self.conversations:
+                key, conversation = next(iter(self.conversations.items()))
+                if now - conversation["last_used"] < self.idle_seconds and len(self.conversations) <= self.max_conversations:
+                    break
+                del self.conversations[key]
+                evicted += 1
+        if evicted:
+            logger.info(f">>>>>> Forgot {evicted} conversations")
+            tracing.increment("conversation_memory_evictions_total", evicted)
+        return evicted
+
+    def _conversation(self, key: Hashable) -> Dict[str, Any]:
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                conversation = self.conversations[key] = {"summary": "", "turns": []}
+            conversation["last_used"] = time.monotonic()
+            self.conversations.move_to_end(key)
+        return conversation
+
+    def history(self, key: Hashable) -> str:
+        """
+        The summary and the recent turns of a conversation as text, empty for a new conversation.
+        """
+        self.evict_idle()
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                return ""
+            summary, turns = conversation["summary"], list(conversation["turns"])
+        parts = [f"Zusammenfassung: {summary}"] if summary else []
+        if turns:
+            parts.append(_format_turns(turns))
+        return "\n".join(parts)
+
+    def standalone_question(self, key: Hashable, question: str) -> str:
+        """
+        Rewrite a follow-up question so it can be answered without the conversation.
+
+        Parameters:
+        - key (Hashable): The conversation, e.g. (channel, user name).
+        - question (str): The new question.
+
+        Returns:
+        - str: The standalone question, the question itself for a new conversation or if the rewrite fails.
+        """
+        history = self.history(key)
+        if not history:
+            return question
+        try:
+            with tracing.span("query_rewrite"):
+                response = call_chatgpt_api_user_promt_system_prompt(f"Verlauf:\n{history}\n\nNeue Frage: {question}",
+                                                                     REWRITE_SYSTEM_PROMPT, max_tokens=200)
+            rewritten = response["choices"][0]["message"]["content"].strip()
+        except Exception as e:
+            logger.error(f"Could not rewrite the question, use it unchanged: {e}")
+            return question
+        logger.info(f">>>>>> Standalone question: {rewritten}")
+        return rewritten or question
+
+    def add_turn(self, key: Hashable, question: str, answer: str) -> None:
+        """
+        Remember a question and its answer, older turns are folded into the summary.
+
+        Parameters:
+        - key (Hashable): The conversation.
+        - question (str): The question as asked by the user.
+        - answer (str): The answer of the bot.
+        """
+        conversation = self._conversation(key)
+        self.evict_idle()
+        with self.lock:
+            conversation["turns"].append({"question": question, "answer": answer})
+            folded = []
+            while len(conversation["turns"]) > 1 and (
+                    len(conversation["turns"]) > self.recent_turns
+                    or estimate_tokens(_format_turns(conversation["turns"])) > MEMORY_RECENT_MAX_TOKENS):
+                folded.append(conversation["turns"].pop(0))
+            summary = conversation["summary"]
+        if folded:
+            summary = self._fold(summary, folded)
+            with self.lock:
+                conversation["summary"] = summary
+
+    def _fold(self, summary: str, turns) -> str:
+        """
+        Merge turns into the summary, the summary stays below summary_max_tokens.
+        """
+        prompt = f"Bisherige Zusammenfassung: {summary or '-'}\n\nNeue Gespraechsrunden:\n{_format_turns(turns)}"
+        try:
+            with tracing.span("memory_summary"):
+                response = call_chatgpt_api_user_promt_system_prompt(prompt, SUMMARY_SYSTEM_PROMPT, max_tokens=self.summary_max_tokens)
+            summary = response["choices"][0]["message"]["content"].strip()
+        except Exception as e:
+            # keep the questions at least, they carry most of the context for a rewrite
+            logger.error(f"Could not summarize the conversation: {e}")
+            summary = " ".join([summary] + [turn["question"] for turn in turns])
+        return _truncate_to_tokens(summary, self.summary_max_tokens)
@@ -0,0 +1,224 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+from typing import Any, Callable, Dict, Iterable, List
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Compiled corpus: a JSONL file ({"id", "text"} per line) turned into arrays that are memory-mapped instead of parsed.
+#
+# header: magic, version, number of entries, name of the tokenizer of the token counts, then (offset, length) of
+#         every section in SECTIONS, offsets are relative to the start of the file
+# lower:  text.lower() of all entries, separated by a NUL byte so no match spans two entries (UTF-8)
+# text:   the original texts (UTF-8)
+# ids:    the ids (UTF-8)
+# *_offsets (uint64) / *_lengths (uint32): position of every entry in the three byte sections
+# tokens (uint32): precomputed token count of every text
+MAGIC = b"KAICORP1"
+VERSION = 1
+COMPILED_SUFFIX = ".corpus"
+SECTIONS = ["lower", "text", "ids", "lower_offsets", "lower_lengths", "text_offsets", "text_lengths", "id_offsets",
+            "id_lengths", "tokens"]
+_header = struct.Struct("<8sHH16sI" + "QQ" * len(SECTIONS))
+
+_open_lock = threading.Lock()
+# compiled path -> (modification time, CompiledCorpus)
+_open_corpora = {}
+
+
+def compiled_path(jsonl_path: str) -> str:
+    """
+    Path of the compiled corpus of a JSONL file, e.g. phat_sharepoint.corpus for phat_sharepoint.jsonl.
+    """
+    return os.path.splitext(jsonl_path)[0] + COMPILED_SUFFIX
+
+
+def build_corpus(jsonl_path: str, count_tokens: Callable[[str], int], tokenizer: str, output_path: str = None) -> str:
+    """
+    Compile a JSONL file, the compiled file replaces an older one atomically.
+
+    Parameters:
+    - jsonl_path (str): The JSONL file.
+    - count_tokens (Callable[[str], int]): Function counting the tokens of a text.
+    - tokenizer (str): Name of the tokenizer, the token counts are only used with the same tokenizer.
+    - output_path (str, optional): The compiled file. Defaults to compiled_path(jsonl_path).
+
+    Returns:
+    - str: Path of the compiled file.
+    """
+    if sys.byteorder != "little":
+        raise ValueError("Compiled corpora store little-endian arrays and can only be built on little-endian machines")
+    output_path = output_path or compiled_path(jsonl_path)
+    buffers = {"lower": bytearray(), "text": bytearray(), "ids": bytearray()}
+    arrays = {name: array("Q" if name.endswith("offsets") else "I") for name in SECTIONS[3:]}
+    with open(jsonl_path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            text = entry.get("text", "")
+            for name, value, offsets, lengths in [("lower", text.lower(), "lower_offsets", "lower_lengths"),
+                                                  ("text", text, "text_offsets", "text_lengths"),
+                                                  ("ids", str(entry.get("id", "")), "id_offsets", "id_lengths")]:
+                encoded = value.encode("utf-8")
+                arrays[offsets].append(len(buffers[name]))
+                arrays[lengths].append(len(encoded))
+                buffers[name] += encoded
+                if name == "lower":
+                    buffers[name] += b"\0"
+            arrays["tokens"].append(count_tokens(text))
+
+    sections = [bytes(buffers[name]) if name in buffers else arrays[name].tobytes() for name in SECTIONS]
+    positions = []
+    position = _header.size
+    for section in sections:
+        position += -position % 8
+        positions.extend([position, len(section)])
+        position += len(section)
+
+    temporary_path = f"{output_path}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(_header.pack(MAGIC, VERSION, 0, tokenizer.encode()[:16], len(arrays["tokens"]), *positions))
+        for offset, section in zip(positions[::2], sections):
+            file.write(b"\0" * (offset - file.tell()))
+            file.write(section)
+    os.replace(temporary_path, output_path)
+    logger.info(f"Compiled {len(arrays['tokens'])} entries of {jsonl_path} into {output_path} ({position} bytes)")
+    return output_path
+
+
+class CompiledCorpus:
+    """
+    Read-only view of a compiled corpus, the sections are used directly from the memory map.
+    """
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise ValueError("Compiled corpora can only be read on little-endian machines")
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, tokenizer, self.count, *positions = _header.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a compiled corpus of version {VERSION}")
+        self.tokenizer = tokenizer.rstrip(b"\0").decode()
+        self.sections = dict(zip(SECTIONS, zip(positions[::2], positions[1::2])))
+        view = memoryview(self.map)
+        for name in SECTIONS[3:]:
+            offset, length = self.sections[name]
+            setattr(self, name, view[offset:offset + length].cast("Q" if name.endswith("offsets") else "I"))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _string(self, section: str, offsets, lengths, index: int) -> str:
+        start = self.sections[section][0] + offsets[index]
+        return self.map[start:start + lengths[index]].decode("utf-8")
+
+    def id(self, index: int) -> str:
+        return self._string("ids", self.id_offsets, self.id_lengths, index)
+
+    def text(self, index: int) -> str:
+        return self._string("text", self.text_offsets, self.text_lengths, index)
+
+    def count_matches(self, words: List[str]) -> Dict[int, int]:
+        """
+        Count how often the words occur in the lowercase text of every entry, like str.count per entry.
+
+        Parameters:
+        - words (List[str]): Lowercase words.
+
+        Returns:
+        - Dict[int, int]: Number of matches per entry index, entries without a match are missing.
+        """
+        base, length = self.sections["lower"]
+        end_of_text = base + length
+        counts = {}
+        for word in words:
+            needle = word.encode("utf-8")
+            if not needle:
+                continue
+            position = self.map.find(needle, base, end_of_text)
+            while position != -1:
+                index = bisect_right(self.lower_offsets, position - base) - 1
+                entry_end = base + self.lower_offsets[index] + self.lower_lengths[index]
+                # only the rest of this entry is copied to count the remaining matches
+                counts[index] = counts.get(index, 0) + self.map[position:entry_end].count(needle)
+                position = self.map.find(needle, entry_end, end_of_text)
+        return counts
+
+    def close(self) -> None:
+        for name in SECTIONS[3:]:
+            getattr(self, name).release()
+        self.map.close()
+
+
+def open_corpus(jsonl_path: str) -> CompiledCorpus:
+    """
+    Open the compiled corpus of a JSONL file, opened corpora are kept open until the compiled file changes.
+
+    Parameters:
+    - jsonl_path (str): The JSONL file.
+
+    Returns:
+    - CompiledCorpus: The compiled corpus, None if it is missing or older than the JSONL file.
+    """
+    path = compiled_path(jsonl_path)
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return None
+    try:
+        if os.path.getmtime(jsonl_path) > modified:
+            logger.warning(f"{path} is older than {jsonl_path}, rebuild it with: python corpus.py {jsonl_path}")
+            return None
+    except OSError:
+        pass
+    with _open_lock:
+        cached = _open_corpora.get(path)
+        if cached and cached[0] == modified:
+            return cached[1]
+        corpus = CompiledCorpus(path)
+        # an older map of a replaced file stays valid for searches still using it
+        _open_corpora[path] = (modified, corpus)
+        return corpus
+
+
+def iter_entries(jsonl_path: str) -> Iterable[Dict[str, Any]]:
+    """
+    Read the entries of a JSONL file from its compiled corpus if there is one, otherwise from the file.
+
+    Returns:
+    - Iterable[Dict[str, Any]]: Entries with "id" and "text".
+    """
+    corpus = open_corpus(jsonl_path)
+    if corpus is None:
+        with open(jsonl_path, "r") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    for index in range(len(corpus)):
+        yield {"id": corpus.id(index), "text": corpus.text(index)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile JSONL corpora into memory-mappable files used by the direct search.")
+    parser.add_argument("jsonl_paths", nargs="+", help="JSONL files, e.g. /home/azureuser/phat_sharepoint.jsonl")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    from chat_utils import TOKENIZER, estimate_tokens
+    for jsonl_path in args.jsonl_paths:
+        build_corpus(jsonl_path, estimate_tokens, TOKENIZER)
+
+
+if __name__ == "__main__":
+    main()
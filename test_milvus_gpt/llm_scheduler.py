@@ -0,0 +1,196 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict
+
+import tracing
+
+import logging
+logger = logging.getLogger(__name__)
+
+# All ChatCompletion calls of one process share these limits, so parallel work (e.g. map-reduce summaries)
+# cannot flood the Azure deployment.
+LLM_MAX_PARALLEL_REQUESTS = int(os.getenv("OPENAI_MAX_PARALLEL_REQUESTS", "4"))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "60"))
+
+# Priority classes, highest first:
+# - interactive: answers to users waiting in a chat (default)
+# - periodic: scheduled work like the reddit summaries
+# - batch: offline jobs like batch_ask and bot_shorten_text
+PRIORITIES = ("interactive", "periodic", "batch")
+# Share of the requests every class gets while several classes are waiting (weighted fair queuing)
+LLM_PRIORITY_WEIGHTS = json.loads(os.getenv("LLM_PRIORITY_WEIGHTS", '{"interactive": 8, "periodic": 2, "batch": 1}'))
+# Slots only interactive requests may use, the other classes never occupy all LLM_MAX_PARALLEL_REQUESTS
+LLM_INTERACTIVE_RESERVED_SLOTS = int(os.getenv("LLM_INTERACTIVE_RESERVED_SLOTS", "1"))
+# Queued batch requests are held back completely while this many interactive requests are waiting
+LLM_PREEMPT_BATCH_QUEUE = int(os.getenv("LLM_PREEMPT_BATCH_QUEUE", "2"))
+
+_local = threading.local()
+
+
+def current_priority() -> str:
+    """
+    The priority class of the LLM calls of this thread, "interactive" unless set with llm_priority.
+    """
+    return getattr(_local, "priority", "interactive")
+
+
+@contextmanager
+def llm_priority(priority: str):
+    """
+    Context manager running the LLM calls of this thread in a priority class.
+
+        with llm_priority("batch"):
+            answer_from_chunks(question, chunks)
+
+    Raises:
+    - ValueError: If the priority class is unknown.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority class: {priority}")
+    previous = getattr(_local, "priority", None)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous if previous is not None else "interactive"
+
+
+class LLMScheduler:
+    """
+    Admits ChatCompletion calls under a concurrency and a rate limit, ordered by priority class.
+
+    - Waiting requests are served first come first served within a class. Between classes the next slot goes to the
+      class with the lowest virtual time (stride scheduling), every request advances the virtual time of its class by
+      1 / weight. A busy batch job therefore gets about weight["batch"] / sum(weights) of the requests while chat users
+      are waiting and all of them when nobody else is.
+    - A class that was idle starts at the current virtual time, it cannot save up credit.
+    - Only interactive requests may use the last reserved_slots slots.
+    - While preempt_batch_queue interactive requests are waiting, queued batch requests are not admitted at all.
+      Requests already sent to Azure are never interrupted.
+    """
+
+    def __init__(self, max_parallel: int = LLM_MAX_PARALLEL_REQUESTS, requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+                 weights: Dict[str, float] = None, reserved_slots: int = LLM_INTERACTIVE_RESERVED_SLOTS,
+                 preempt_batch_queue: int = LLM_PREEMPT_BATCH_QUEUE):
+        self.max_parallel = max_parallel
+        self.interval = 60.0 / requests_per_minute
+        self.weights = dict(LLM_PRIORITY_WEIGHTS, **(weights or {}))
+        self.reserved_slots = min(reserved_slots, max_parallel - 1)
+        self.preempt_batch_queue = preempt_batch_queue
+        self.condition = threading.Condition()
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.running = dict.fromkeys(PRIORITIES, 0)
+        self.virtual_times = dict.fromkeys(PRIORITIES, 0.0)
+        self.virtual_time = 0.0
+        self.next_start = 0.0
+
+    def _choose(self):
+        """
+        The class whose first request is admitted next and whether batch requests were held back, None if no slot
+        is free.
+        """
+        in_flight = sum(self.running.values())
+        if in_flight >= self.max_parallel:
+            return None, False
+        preempted = False
+        candidates = []
+        for priority in PRIORITIES:
+            if not self.queues[priority]:
+                continue
+            if priority != "interactive" and in_flight >= self.max_parallel - self.reserved_slots:
+                continue
+            if priority == "batch" and len(self.queues["interactive"]) >= self.preempt_batch_queue:
+                preempted = True
+                continue
+            candidates.append((self.virtual_times[priority], PRIORITIES.index(priority), priority))
+        if not candidates:
+            return None, preempted
+        return min(candidates)[2], preempted
+
+    def acquire(self, priority: str, timeout: float = None) -> float:
+        """
+        Block until a request of the class may be sent.
+
+        Parameters:
+        - priority (str): The priority class.
+        - timeout (float, optional): Seconds to wait at most, no limit if not given.
+
+        Returns:
+        - float: Seconds the request waited.
+
+        Raises:
+        - TimeoutError: If the request was not admitted within the timeout.
+        """
+        enqueued = time.monotonic()
+        ticket = object()
+        with self.condition:
+            queue = self.queues[priority]
+            if not queue and not self.running[priority]:
+                self.virtual_times[priority] = max(self.virtual_times[priority], self.virtual_time)
+            queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    chosen, preempted = self._choose()
+                    if chosen == priority and queue[0] is ticket and now >= self.next_start:
+                        break
+                    if timeout is not None and now - enqueued >= timeout:
+                        tracing.increment("llm_queue_timeouts_total", priority=priority)
+                        raise TimeoutError(f"No LLM slot for a {priority} request within {timeout:.1f} seconds")
+                    wait = None
+                    if chosen == priority and queue[0] is ticket:
+                        wait = self.next_start - now
+                    if timeout is not None:
+                        wait = min(wait if wait is not None else timeout, enqueued + timeout - now)
+                    self.condition.wait(wait)
+            except BaseException:
+                queue.remove(ticket)
+                self.condition.notify_all()
+                raise
+            queue.popleft()
+            self.running[priority] += 1
+            self.virtual_time = self.virtual_times[priority]
+            self.virtual_times[priority] += 1.0 / self.weights.get(priority, 1.0)
+            self.next_start = max(now, self.next_start) + self.interval
+            self.condition.notify_all()
+        waited = now - enqueued
+        if preempted:
+            tracing.increment("llm_batch_preemptions_total")
+        tracing.observe("llm_queue_wait_seconds", waited, priority=priority)
+        return waited
+
+    def release(self, priority: str) -> None:
+        with self.condition:
+            self.running[priority] -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority: str = None, timeout: float = None):
+        """
+        Context manager holding a slot for one ChatCompletion call, see acquire.
+
+        Parameters:
+        - priority (str, optional): The priority class. Defaults to current_priority().
+        - timeout (float, optional): Seconds to wait for the slot at most.
+        """
+        priority = priority or current_priority()
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority class: {priority}")
+        self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def queued(self, priority: str) -> int:
+        return len(self.queues[priority])
+
+
+scheduler = LLMScheduler()
+tracing.register_gauge("llm_in_flight_requests", lambda: sum(scheduler.running.values()))
+for _priority in PRIORITIES:
+    tracing.register_gauge(f"llm_queued_requests_{_priority}", lambda priority=_priority: scheduler.queued(priority))
@@ -0,0 +1,116 @@
+import atexit
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict
+
+import logging
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Level of the root logger, e.g. DEBUG, INFO, WARNING (the default is the level passed to configure_logging)
+LOG_LEVEL = os.getenv("LOG_LEVEL")
+# Levels per module, e.g. "chat_utils=WARNING,chat_utils.chunks=DEBUG", they override DEFAULT_MODULE_LEVELS
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# Share of the retrievals whose chunk texts are logged, 0 logs none, 1 logs all
+LOG_CHUNK_SAMPLE_RATE = float(os.getenv("LOG_CHUNK_SAMPLE_RATE", "0.1"))
+# Logged texts (chunks, prompts, reddit threads) are cut to this many characters
+LOG_TEXT_MAX_CHARS = int(os.getenv("LOG_TEXT_MAX_CHARS", "300"))
+
+DEFAULT_MODULE_LEVELS = {
+    "requests": "WARNING",
+    "urllib3": "WARNING",
+}
+
+_listener = None
+
+
+class Truncated:
+    """
+    Log argument that is cut to max_chars characters, only when the record is formatted by the writer thread.
+
+        logger.info(">>>>>> Context: %s", Truncated(context))
+    """
+
+    __slots__ = ("text", "max_chars")
+
+    def __init__(self, text: str, max_chars: int = None):
+        self.text = text
+        self.max_chars = LOG_TEXT_MAX_CHARS if max_chars is None else max_chars
+
+    def __str__(self) -> str:
+        if len(self.text) <= self.max_chars:
+            return self.text
+        return f"{self.text[:self.max_chars]}... ({len(self.text)} characters)"
+
+
+def sample_chunks() -> bool:
+    """
+    Decide whether the chunk texts of one retrieval are logged, see LOG_CHUNK_SAMPLE_RATE.
+    """
+    return LOG_CHUNK_SAMPLE_RATE >= 1 or random.random() < LOG_CHUNK_SAMPLE_RATE
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Puts the records into the queue unformatted, so the message is formatted by the writer thread instead of the
+    thread that logs. The arguments of a record must therefore not be changed after logging it.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _parse_levels(levels: str) -> Dict[str, str]:
+    parsed = {}
+    for entry in levels.split(","):
+        if entry.strip():
+            name, _, level = entry.partition("=")
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure_logging(log_file: str = None, level: int = logging.INFO) -> None:
+    """
+    Log through a queue: the logging threads only enqueue the records, one background thread formats them and
+    writes them to the log file and stderr. The queue is flushed when the process exits.
+
+    Parameters:
+    - log_file (str, optional): File the log is appended to, only stderr if not given.
+    - level (int, optional): Level of the root logger if LOG_LEVEL is not set. Defaults to logging.INFO.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(log_file)] if log_file else []
+    handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL.upper() if LOG_LEVEL else level)
+    for name, module_level in dict(DEFAULT_MODULE_LEVELS, **_parse_levels(LOG_LEVELS)).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """
+    Write the queued records and stop the writer thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,184 @@
+import json
+import math
+import os
+import re
+from typing import Any, Dict, List
+
+import tracing
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Number of chunks kept after reranking, 0 keeps all chunks (only reorders them)
+RERANK_KEEP = int(os.getenv("RERANK_KEEP", "8"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Weights of the features, every feature is scaled to 0..1 over the candidates of one question
+FEATURE_WEIGHTS = {
+    "bm25": 1.0,
+    "proximity": 0.4,
+    "title": 0.6,
+    "retrieval": 0.5,
+}
+# Bonus per collection ("collection" field) or source type ("source" field) of the chunk, e.g.
+# {"profiles": 0.2, "vector": 0.1, "direct_search": 0.0}
+SOURCE_PRIORS = json.loads(os.getenv("RERANK_SOURCE_PRIORS", '{"vector": 0.1, "direct_search": 0.0}'))
+
+_word_pattern = re.compile(r"\w+", re.UNICODE)
+_chunk_number_pattern = re.compile(r"_\d+$")
+STOPWORDS = {
+    "phatgpt", "der", "die", "das", "den", "dem", "des", "ein", "eine", "einen", "einem", "einer", "und", "oder",
+    "ist", "sind", "war", "wer", "was", "wie", "wo", "wann", "warum", "welche", "welcher", "welches", "mit", "von",
+    "zu", "zum", "zur", "im", "in", "an", "am", "auf", "fuer", "bei", "ueber", "nach", "aus", "es", "ich", "du",
+    "er", "sie", "wir", "ihr", "mir", "mich", "dir", "uns", "kann", "kannst", "hat", "hast", "haben", "gibt",
+    "nicht", "auch", "noch", "so", "the", "a", "of", "is", "what", "who", "how", "and", "or", "to",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text into lowercase words with umlauts written as in the corpus (ae, oe, ue, ss).
+    """
+    text = text.lower().replace('ä', 'ae').replace('ü', 'ue').replace('ö', 'oe').replace('ß', 'ss')
+    return _word_pattern.findall(text)
+
+
+def query_terms(question: str) -> List[str]:
+    """
+    The distinct words of a question without stopwords, in the order of the question.
+    """
+    terms = []
+    for word in tokenize(question):
+        if len(word) > 1 and word not in STOPWORDS and word not in terms:
+            terms.append(word)
+    return terms
+
+
+def _scale(values: List[float], equal: float = 0.0) -> List[float]:
+    """
+    Min-max scale values to 0..1, all values are set to equal if they do not differ.
+    """
+    low, high = min(values), max(values)
+    if high - low <= 0:
+        return [equal] * len(values)
+    return [(value - low) / (high - low) for value in values]
+
+
+def _proximity(positions: Dict[str, List[int]]) -> float:
+    """
+    Score how close the matched query terms are to each other: the number of matched terms divided by the length of
+    the smallest window containing all of them, 0 when less than two terms match.
+    """
+    if len(positions) < 2:
+        return 0.0
+    occurrences = sorted((position, term) for term, term_positions in positions.items() for position in term_positions)
+    counts = {}
+    best = None
+    left = 0
+    for position, term in occurrences:
+        counts[term] = counts.get(term, 0) + 1
+        while len(counts) == len(positions):
+            window = position - occurrences[left][0] + 1
+            best = window if best is None else min(best, window)
+            left_term = occurrences[left][1]
+            counts[left_term] -= 1
+            if not counts[left_term]:
+                del counts[left_term]
+            left += 1
+    return len(positions) / best
+
+
+def score_chunks(question: str, chunks: List[Dict[str, Any]]) -> List[Dict[str, float]]:
+    """
+    Compute the lexical features and the combined score of every chunk for a question.
+
+    - bm25: BM25 of the question terms, document frequencies are taken from the candidates.
+    - proximity: How close the matched question terms stand together in the chunk.
+    - title: Share of the question terms found in the id of the chunk (e.g. the person name of a profile).
+    - retrieval: The score of the retrieval, scaled per source since vector and direct search scores differ.
+
+    Parameters:
+    - question (str): The user's question.
+    - chunks (List[Dict[str, Any]]): The candidates with "id", "text" and optionally "score", "source_id" and "source".
+
+    Returns:
+    - List[Dict[str, float]]: The features and the "score" of every chunk, in the order of the chunks.
+    """
+    terms = query_terms(question)
+    documents = [tokenize(chunk["text"]) for chunk in chunks]
+    average_length = sum(len(words) for words in documents) / max(1, len(documents))
+
+    document_frequency = dict.fromkeys(terms, 0)
+    term_positions = []
+    for words in documents:
+        positions = {}
+        for position, word in enumerate(words):
+            if word in document_frequency:
+                positions.setdefault(word, []).append(position)
+        for term in positions:
+            document_frequency[term] += 1
+        term_positions.append(positions)
+
+    idf = {term: math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+           for term, frequency in document_frequency.items()}
+    bm25 = []
+    for words, positions in zip(documents, term_positions):
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * len(words) / max(1.0, average_length))
+        bm25.append(sum(idf[term] * len(occurrences) * (BM25_K1 + 1) / (len(occurrences) + length_norm)
+                        for term, occurrences in positions.items()))
+
+    title_scores = []
+    for chunk in chunks:
+        title = _chunk_number_pattern.sub("", chunk.get("source_id") or chunk["id"] or "")
+        title_words = set(tokenize(title.replace("_", " ")))
+        title_scores.append(sum(1 for term in terms if term in title_words) / len(terms) if terms else 0.0)
+
+    retrieval = [0.0] * len(chunks)
+    for source in {chunk.get("source") for chunk in chunks}:
+        indices = [i for i, chunk in enumerate(chunks) if chunk.get("source") == source]
+        for i, value in zip(indices, _scale([float(chunks[i].get("score") or 0) for i in indices], equal=1.0)):
+            retrieval[i] = value
+
+    features = {
+        "bm25": _scale(bm25) if chunks else [],
+        "proximity": [_proximity(positions) for positions in term_positions],
+        "title": title_scores,
+        "retrieval": retrieval,
+    }
+    scores = []
+    for i, chunk in enumerate(chunks):
+        chunk_features = {name: round(values[i], 4) for name, values in features.items()}
+        chunk_features["score"] = round(sum(FEATURE_WEIGHTS[name] * value for name, value in chunk_features.items())
+                                        + SOURCE_PRIORS.get(chunk.get("collection"), SOURCE_PRIORS.get(chunk.get("source"), 0.0)), 4)
+        scores.append(chunk_features)
+    return scores
+
+
+@tracing.traced("rerank")
+def rerank(question: str, chunks: List[Dict[str, Any]], keep: int = None) -> List[Dict[str, Any]]:
+    """
+    Order the retrieved chunks by local lexical features and keep only the best ones.
+
+    Parameters:
+    - question (str): The user's question.
+    - chunks (List[Dict[str, Any]]): The retrieved chunks.
+    - keep (int, optional): Number of chunks to keep, 0 keeps all. Defaults to RERANK_KEEP.
+
+    Returns:
+    - List[Dict[str, Any]]: The best chunks, best first, with their "rerank_score".
+    """
+    keep = RERANK_KEEP if keep is None else keep
+    if not chunks:
+        return chunks
+    scored = [dict(chunk, rerank_score=features["score"]) for chunk, features in zip(chunks, score_chunks(question, chunks))]
+    # stable sort keeps the retrieval order between chunks with the same score
+    scored.sort(key=lambda chunk: chunk["rerank_score"], reverse=True)
+    kept = scored[:keep] if keep else scored
+
+    tokens_before = sum(chunk["tokens"] for chunk in chunks)
+    tokens_after = sum(chunk["tokens"] for chunk in kept)
+    logger.info(f">>>>>> Rerank: {len(chunks)} -> {len(kept)} chunks, {tokens_before} -> {tokens_after} tokens, "
+                f"best {', '.join(chunk['id'] for chunk in kept[:3])}")
+    tracing.annotate(candidates=len(chunks), kept=len(kept), tokens_before=tokens_before, tokens_after=tokens_after)
+    tracing.increment("rerank_tokens_saved_total", tokens_before - tokens_after)
+    return kept
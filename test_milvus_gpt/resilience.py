@@ -0,0 +1,100 @@
+import threading
+import time
+
+import tracing
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Deadline:
+    """
+    Point in time by which a request has to be answered, the stages of the request take shares of the remaining time.
+    """
+
+    def __init__(self, seconds: float):
+        self.end = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """
+        Seconds left until the deadline, never below zero.
+        """
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def share(self, fraction: float) -> "Deadline":
+        """
+        Create a deadline for a stage that may use a fraction of the remaining time.
+
+        Parameters:
+        - fraction (float): Share of the remaining time, between 0 and 1.
+
+        Returns:
+        - Deadline: The deadline of the stage.
+        """
+        return Deadline(self.remaining() * fraction)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a backend whose circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a backend that keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and calls fail immediately with CircuitOpenError.
+    Every reset_seconds one call is let through as a probe, if it succeeds the circuit closes again, if it fails the
+    circuit stays open for another reset_seconds.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        tracing.register_gauge(f"circuit_breaker_open_{name}", lambda: int(self.opened_at is not None))
+
+    def before_call(self) -> None:
+        """
+        Check whether the backend may be called.
+
+        Raises:
+        - CircuitOpenError: If the circuit is open and no probe is due.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.monotonic() - self.opened_at < self.reset_seconds:
+                tracing.increment("circuit_breaker_rejected_total", breaker=self.name)
+                raise CircuitOpenError(f"Circuit breaker {self.name} is open")
+            self.probing = True
+        logger.info(f">>>>>> Circuit breaker {self.name}: probing the backend")
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f">>>>>> Circuit breaker {self.name}: backend recovered, closing")
+                tracing.increment("circuit_breaker_transitions_total", breaker=self.name, state="closed")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.probing:
+                # failed probe, wait another reset_seconds
+                self.opened_at = time.monotonic()
+                self.probing = False
+            elif self.opened_at is None and self.failures >= self.failure_threshold:
+                logger.warning(f">>>>>> Circuit breaker {self.name}: {self.failures} failures in a row, opening")
+                tracing.increment("circuit_breaker_transitions_total", breaker=self.name, state="open")
+                self.opened_at = time.monotonic()
@@ -0,0 +1,173 @@
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Set
+
+import chat_utils
+import tracing
+from corpus import iter_entries
+from rerank import query_terms, tokenize
+from resilience import Deadline
+
+import logging
+logger = logging.getLogger(__name__)
+
+PROFILES_JSONL_PATH = os.getenv("PROFILES_JSONL_PATH", "/home/azureuser/updated_file.jsonl")
+
+# Named collections, each with its own backend and share of the context budget.
+# - backend: "vector" (retrieval plugin on "port", default RETRIEVAL_PLUGIN_PORT) or "jsonl" (word search in "path")
+# - route: "always", or "person" to only search the collection for questions about people
+# - share: share of the context budget, the shares of the chosen collections are normalized
+# - retrieval_settings: overrides of DEFAULT_RETRIEVAL_SETTINGS for a vector backend
+# Can be replaced with the RETRIEVAL_COLLECTIONS environment variable (JSON in the same format).
+DEFAULT_COLLECTIONS = {
+    "sharepoint": {"backend": "vector", "route": "always", "share": 0.6},
+    "profiles": {"backend": "jsonl", "path": PROFILES_JSONL_PATH, "route": "person", "share": 0.4},
+}
+
+# Words that make a question a question about people even without a known name
+_person_question_pattern = re.compile(r"\b(wer|wem|wen|wessen|kollege\w*|kollegin\w*|ansprechpartner\w*|mitarbeiter\w*|"
+                                      r"experte\w*|expertin\w*|kennt sich)\b", re.IGNORECASE)
+_chunk_number_pattern = re.compile(r"_\d+$")
+_names_lock = threading.Lock()
+# path -> (modification time, names)
+_names_cache = {}
+_fan_out_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="collections")
+
+
+def load_collections(collections: Dict[str, Dict[str, Any]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Return the collection definitions, from the argument, the RETRIEVAL_COLLECTIONS environment variable or the
+    defaults.
+
+    Raises:
+    - ValueError: If a collection has an unknown backend or route.
+    """
+    if collections is None:
+        collections = json.loads(os.getenv("RETRIEVAL_COLLECTIONS", "null")) or DEFAULT_COLLECTIONS
+    for name, collection in collections.items():
+        if collection.get("backend") not in ("vector", "jsonl"):
+            raise ValueError(f"Unknown backend of collection {name}: {collection.get('backend')}")
+        if collection.get("route", "always") not in ("always", "person"):
+            raise ValueError(f"Unknown route of collection {name}: {collection.get('route')}")
+    return collections
+
+
+def known_names(path: str) -> Set[str]:
+    """
+    Read the person names from the ids of a profile JSONL file ("Kai_Luenstaeden_3" -> {"kai", "luenstaeden"}).
+
+    The names are cached until the file changes, a missing file has no names.
+    """
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return set()
+    with _names_lock:
+        cached = _names_cache.get(path)
+        if cached and cached[0] == modified:
+            return cached[1]
+    names = set()
+    for entry in iter_entries(path):
+        entry_id = str(entry.get("id", ""))
+        names.update(word for word in tokenize(_chunk_number_pattern.sub("", entry_id).replace("_", " ")) if len(word) > 2)
+    with _names_lock:
+        _names_cache[path] = (modified, names)
+    return names
+
+
+def is_person_question(question: str, collections: Dict[str, Dict[str, Any]]) -> bool:
+    """
+    Cheap check whether a question asks about people: it contains a name of a person profile or a word like "wer".
+    """
+    if _person_question_pattern.search(question):
+        return True
+    terms = set(query_terms(question))
+    for collection in collections.values():
+        if collection.get("route") == "person" and collection["backend"] == "jsonl" and terms & known_names(collection["path"]):
+            return True
+    return False
+
+
+def route(question: str, collections: Dict[str, Dict[str, Any]]) -> List[str]:
+    """
+    Choose the collections to search for a question.
+
+    Parameters:
+    - question (str): The user's question.
+    - collections (Dict[str, Dict[str, Any]]): The collection definitions.
+
+    Returns:
+    - List[str]: Names of the chosen collections.
+    """
+    person = is_person_question(question, collections)
+    chosen = [name for name, collection in collections.items()
+              if collection.get("route", "always") == "always" or person]
+    logger.info(f">>>>>> Route question to {', '.join(chosen)}{' (person question)' if person else ''}")
+    return chosen
+
+
+def _search_collection(name: str, collection: Dict[str, Any], question: str, bearer_token: str, server_ip: str,
+                       max_context_tokens: int, deadline: Deadline, retrieval_settings: Dict[str, Any]) -> List[Dict[str, Any]]:
+    with tracing.span(f"retrieval.collection.{name}"):
+        if collection["backend"] == "vector":
+            settings = dict(retrieval_settings or {}, **collection.get("retrieval_settings", {}))
+            chunks = chat_utils.query_database(question, bearer_token, server_ip, max_context_tokens=max_context_tokens,
+                                               retrieval_settings=settings, deadline=deadline, port=collection.get("port"))
+        else:
+            chunks = chat_utils.search_jsonl(collection["path"], " ".join(query_terms(question)),
+                                             max_context_tokens=max_context_tokens)
+    return [dict(chunk, collection=name) for chunk in chunks]
+
+
+def retrieve_collections(question: str, bearer_token: str, server_ip: str, max_context_tokens: int,
+                         collections: Dict[str, Dict[str, Any]] = None, deadline: Deadline = None,
+                         retrieval_settings: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+    """
+    Search the collections chosen for a question in parallel and merge their chunks under one budget.
+
+    Every chosen collection gets its share of max_context_tokens, the chunks are merged by alternating between the
+    collections in rank order. A failing collection is skipped as long as another one answers.
+
+    Parameters:
+    - question (str): The user's question.
+    - bearer_token (str): Token for database authentication.
+    - server_ip (str): IP address of the retrieval plugins.
+    - max_context_tokens (int): Token budget of all chunks.
+    - collections (Dict[str, Dict[str, Any]], optional): The collection definitions. Defaults to load_collections().
+    - deadline (Deadline, optional): Deadline of the retrieval.
+    - retrieval_settings (Dict[str, Any], optional): Overrides of DEFAULT_RETRIEVAL_SETTINGS for vector backends.
+
+    Returns:
+    - List[Dict[str, Any]]: The merged chunks with their "collection".
+
+    Raises:
+    - Exception: The error of the first collection if all chosen collections failed.
+    """
+    collections = load_collections(collections)
+    chosen = route(question, collections)
+    total_share = sum(collections[name].get("share", 1.0) for name in chosen)
+    futures = {name: _fan_out_executor.submit(_search_collection, name, collections[name], question, bearer_token, server_ip,
+                                              int(max_context_tokens * collections[name].get("share", 1.0) / total_share),
+                                              deadline, retrieval_settings)
+               for name in chosen}
+
+    results = []
+    errors = []
+    for name, future in futures.items():
+        try:
+            results.append(future.result(timeout=deadline.remaining() if deadline else None))
+        except Exception as e:
+            logger.warning(f">>>>>> Collection {name} failed: {type(e).__name__}: {e}")
+            tracing.increment("collection_errors_total", collection=name)
+            errors.append(e)
+    if errors and not results:
+        raise errors[0]
+
+    merged = []
+    for rank in range(max((len(chunks) for chunks in results), default=0)):
+        merged.extend(chunks[rank] for chunks in results if rank < len(chunks))
+    tracing.annotate(collections=",".join(chosen), chunks=len(merged))
+    return merged
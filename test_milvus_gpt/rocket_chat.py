@@ -6,7 +6,18 @@ from datetime import datetime
 import openai
 from rocketchat_API.rocketchat import RocketChat
 
-from chat_utils import ask
+if os.getenv("ASK_SERVICE_URL"):
+    # thin client of the shared ask service, the service warms its cache itself
+    from ask_client import ask
+    CacheWarmer = None
+else:
+    from cache_warming import CacheWarmer
+    from chat_utils import ask
+import tracing
+from conversation_memory import ConversationMemory
+
+# follow-up questions of every user in a channel
+conversation_memory = ConversationMemory()
 
 def load_config(filename='config.json'):
     """
@@ -42,13 +53,16 @@ def get_last_responded_timestamp(timestamp_file):
     except (FileNotFoundError, ValueError):
         return None
 
-def respond_to_mention(rocket, server_ip: str, channel='GENERAL', timestamp_file='timestamp.txt'):
+def respond_to_mention(rocket, server_ip: str, channel='GENERAL', timestamp_file='timestamp.txt', retrieval_settings=None,
+                       source="vector"):
     """
     Responds to the latest mention in the given channel that is newer than the last responded timestamp.
 
     :param rocket: The RocketChat object
     :param channel: The channel to monitor
     :param timestamp_file: The file to store the timestamp of the last responded message
+    :param retrieval_settings: Overrides of the default vector retrieval settings
+    :param source: Where ask retrieves the chunks, "vector", "direct_search" or "collections"
     """
     last_responded_timestamp = get_last_responded_timestamp(timestamp_file)
     history = rocket.channels_history(channel, count=10).json()
@@ -63,9 +77,12 @@ def respond_to_mention(rocket, server_ip: str, channel='GENERAL', timestamp_file
             if last_responded_timestamp is None or message_timestamp > last_responded_timestamp:
                 if message['u']['username'] == "PhatGpt":
                     continue
-                answer = ask(message['msg'], os.environ['BEARER_TOKEN'], server_ip)
+                conversation = (channel, message['u']['username'])
+                question = conversation_memory.standalone_question(conversation, message['msg'])
+                answer = ask(question, os.environ['BEARER_TOKEN'], server_ip, retrieval_settings=retrieval_settings, source=source)
                 response = f"@{message['u']['username']} {answer}"
                 rocket.chat_post_message(response, channel=channel)
+                conversation_memory.add_turn(conversation, message['msg'], answer)
 
                 with open(timestamp_file, 'w') as f:
                     f.write(message['_updatedAt'].replace('+00:00', 'Z'))
@@ -75,11 +92,18 @@ def respond_to_mention(rocket, server_ip: str, channel='GENERAL', timestamp_file
 def main():
     config_details = load_config()
     initialize_openai(config_details)
+    tracing.start_metrics_server()
     rocket = RocketChat('PhatGpt', 'phatgpt', server_url=f'http://{config_details["SERVER_IP"]}:3000')
+    # answers the frequent questions while nobody asks
+    cache_warmer = CacheWarmer(os.environ['BEARER_TOKEN']) if CacheWarmer else None
 
     while True:
-        respond_to_mention(rocket, config_details["SERVER_IP"])
-        time.sleep(10)
+        respond_to_mention(rocket, config_details["SERVER_IP"], retrieval_settings=config_details.get("RETRIEVAL"),
+                           source=config_details.get("SOURCE", "vector"))
+        if cache_warmer:
+            cache_warmer.idle(10)
+        else:
+            time.sleep(10)
 
 if __name__ == '__main__':
     main()
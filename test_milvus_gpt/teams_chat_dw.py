@@ -1,3 +1,4 @@
+import json
 import os
 import time
 import logging
@@ -6,7 +7,16 @@ import openai
 from datetime import datetime
 from dateutil.parser import parse
 
-from chat_utils import ask
+if os.getenv("ASK_SERVICE_URL"):
+    # thin client of the shared ask service, the service warms its cache itself
+    from ask_client import ask
+    CacheWarmer = None
+else:
+    from cache_warming import CacheWarmer
+    from chat_utils import ask
+import tracing
+from conversation_memory import ConversationMemory
+from log_config import configure_logging
 
 def get_env_variable(var_name):
     value = os.getenv(var_name)
@@ -22,6 +32,10 @@ BEARER_TOKEN = get_env_variable('BEARER_TOKEN')
 SERVER_IP = get_env_variable("SERVER_IP")
 SCOPES = 'https://graph.microsoft.com/.default'
 TOKEN_FILE_PATH = "teams_access_token.txt"
+# Overrides of the default vector retrieval settings as JSON, e.g. {"top_k": 30, "min_score": 0.75}
+RETRIEVAL_SETTINGS = json.loads(os.getenv("RETRIEVAL_SETTINGS", "{}"))
+# follow-up questions of every user in the chat
+conversation_memory = ConversationMemory()
 
 
 
@@ -253,14 +267,41 @@ def set_last_timestamp(timestamp):
         file.write(str(timestamp))
 
 
+def handle_message(access_token, chat_id, message):
+    """
+    Answer a chat message if it is addressed to phatgpt.
+
+    Args:
+        access_token (str): The access token to authenticate the request.
+        chat_id (str): The ID of the chat the message belongs to.
+        message (dict): The message as returned by the Graph API.
+
+    Returns:
+        datetime.datetime: The creation time of the message.
+    """
+    content = message['body']['content'].replace("<p>", "").replace("</p>", "")
+    timestamp = parse(message['createdDateTime'])
+
+    # Check if the message starts with '<p>phatgpt' and mirror it if it does
+    if content.lower().startswith('phatgpt'):
+        user = ((message.get('from') or {}).get('user') or {}).get('id')
+        conversation = (chat_id, user)
+        question = conversation_memory.standalone_question(conversation, content)
+        answer_vector = ask(question, BEARER_TOKEN, SERVER_IP, retrieval_settings=RETRIEVAL_SETTINGS)
+        answer_direct_question = ask(question, BEARER_TOKEN, SERVER_IP, source="direct_search")
+
+        send_message_to_chat(access_token, chat_id, f"answer vectorsearch: {answer_vector}")
+        send_message_to_chat(access_token, chat_id, f"answer directsearch: {answer_direct_question}")
+        conversation_memory.add_turn(conversation, content, answer_vector)
+
+    return timestamp
+
+
 def main():
     initialize_openai()
+    tracing.start_metrics_server()
     
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        handlers=[logging.FileHandler('teams_chat.log'), logging.StreamHandler()])
-    logging.getLogger("requests").setLevel(logging.WARNING)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    configure_logging('teams_chat.log', level=logging.DEBUG)
     
     last_timestamp = get_last_timestamp()
     
@@ -272,6 +313,8 @@ def main():
         return
 
     chat_id = chat_gpt['id']
+    # answers the frequent questions while nobody asks
+    cache_warmer = CacheWarmer(BEARER_TOKEN) if CacheWarmer else None
 
     # Consider adding an exit condition or loop limit for safety
     while True:
@@ -284,22 +327,14 @@ def main():
             continue
         
         for message in messages:
-            content = message['body']['content'].replace("<p>", "").replace("</p>", "")
-            timestamp = parse(message['createdDateTime'])
-
-            # Check if the message starts with '<p>phatgpt' and mirror it if it does
-            if content.lower().startswith('phatgpt'):
-                answer_vector = ask(content, BEARER_TOKEN, SERVER_IP, max_characters_extra_info=48000)
-                answer_direct_question = ask(content, BEARER_TOKEN, SERVER_IP, source="direct_search", max_characters_extra_info=48000)
-
-                send_message_to_chat(access_token, chat_id, f"answer vectorsearch: {answer_vector}")
-                send_message_to_chat(access_token, chat_id, f"answer directsearch: {answer_direct_question}")
-
             # Update the last timestamp
-            last_timestamp = timestamp
+            last_timestamp = handle_message(access_token, chat_id, message)
             
         set_last_timestamp(last_timestamp)
-        time.sleep(3)  # Consider making this a constant or configurable value
+        if cache_warmer:
+            cache_warmer.idle(3)
+        else:
+            time.sleep(3)  # Consider making this a constant or configurable value
 
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Metrics are collected when a metrics port or a trace file is configured, otherwise every function here returns
+# immediately.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE")
+ENABLED = bool(METRICS_PORT or TRACE_FILE)
+
+HISTOGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauge_callbacks = {}
+_local = threading.local()
+
+
+def enable(trace_file: str = None) -> None:
+    """
+    Turn on metric collection at runtime, optionally writing JSON trace lines to a file.
+
+    Parameters:
+    - trace_file (str, optional): File the finished spans are appended to as JSON lines.
+    """
+    global ENABLED, TRACE_FILE
+    ENABLED = True
+    if trace_file:
+        TRACE_FILE = trace_file
+
+
+def _key(name: str, labels: Dict[str, Any]):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """
+    Add a value to a histogram.
+
+    Parameters:
+    - name (str): Metric name.
+    - value (float): The observed value.
+    - **labels: Labels of the time series.
+    """
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(HISTOGRAM_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    """
+    Increase a counter.
+
+    Parameters:
+    - name (str): Metric name.
+    - value (float, optional): The increment. Defaults to 1.
+    - **labels: Labels of the time series.
+    """
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def register_gauge(name: str, callback: Callable[[], float]) -> None:
+    """
+    Register a gauge whose value is read when the metrics are scraped.
+
+    Parameters:
+    - name (str): Metric name.
+    - callback (Callable[[], float]): Function returning the current value.
+    """
+    _gauge_callbacks[name] = callback
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Measure the duration of a stage of the answer path.
+
+    The yielded dictionary can be filled with attributes (chunk counts, tokens, ...) that are written to the trace
+    line. The duration is recorded in the "answer_stage_duration_seconds" histogram.
+
+    Parameters:
+    - name (str): Name of the stage, e.g. "retrieval.vector".
+    - **attributes: Initial attributes of the span.
+    """
+    if not ENABLED:
+        yield attributes
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    trace_id = stack[0]["trace_id"] if stack else uuid.uuid4().hex[:16]
+    current = {"trace_id": trace_id, "span": name, "parent": stack[-1]["span"] if stack else None, "attributes": attributes}
+    stack.append(current)
+    start = time.perf_counter()
+    try:
+        yield attributes
+    except Exception as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stack.pop()
+        observe("answer_stage_duration_seconds", duration, stage=name)
+        if "error" in attributes:
+            increment("answer_stage_errors_total", stage=name)
+        if TRACE_FILE:
+            current.update(start=time.time() - duration, duration_ms=round(duration * 1000, 2))
+            line = json.dumps(current, default=str)
+            with _lock:
+                with open(TRACE_FILE, "a") as trace_file:
+                    trace_file.write(line + "\n")
+
+
+def traced(name: str):
+    """
+    Decorator running the whole function inside a span.
+
+    Parameters:
+    - name (str): Name of the stage.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes) -> None:
+    """
+    Add attributes to the innermost running span of this thread.
+
+    Parameters:
+    - **attributes: The attributes, e.g. chunks=12.
+    """
+    if not ENABLED:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1]["attributes"].update(attributes)
+
+
+def record_llm_usage(response: Dict[str, Any], engine: str) -> Dict[str, int]:
+    """
+    Count the prompt and completion tokens of a ChatCompletion response.
+
+    Parameters:
+    - response (Dict[str, Any]): The response of the API.
+    - engine (str): The engine used for the call.
+
+    Returns:
+    - Dict[str, int]: The usage of the response, empty if the response has none.
+    """
+    usage = response.get("usage") or {}
+    if ENABLED and usage:
+        increment("llm_prompt_tokens_total", usage.get("prompt_tokens", 0), engine=engine)
+        increment("llm_completion_tokens_total", usage.get("completion_tokens", 0), engine=engine)
+    return usage
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def render_metrics() -> str:
+    """
+    Render all metrics in the Prometheus text format.
+
+    Returns:
+    - str: The metrics.
+    """
+    lines = []
+    with _lock:
+        histograms = {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                      for key, value in _histograms.items()}
+        counters = dict(_counters)
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (metric_name, labels), histogram in sorted(histograms.items()):
+            if metric_name != name:
+                continue
+            for bound, count in zip(HISTOGRAM_BUCKETS, histogram["buckets"]):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (metric_name, labels), value in sorted(counters.items()):
+            if metric_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for name, callback in sorted(_gauge_callbacks.items()):
+        try:
+            value = callback()
+        except Exception as e:
+            logger.error(f"Could not read gauge {name}: {e}")
+            continue
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        payload = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_metrics_server(port: int = None) -> ThreadingHTTPServer:
+    """
+    Serve the metrics on http://127.0.0.1:<port>/metrics in a background thread and enable collection.
+
+    Parameters:
+    - port (int, optional): The port. Defaults to the METRICS_PORT environment variable.
+
+    Returns:
+    - ThreadingHTTPServer: The running server, or None if no port is configured.
+    """
+    port = port or METRICS_PORT
+    if not port:
+        return None
+    enable()
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return server